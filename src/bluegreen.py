@@ -2,36 +2,814 @@
 
 import os
 import sys
-import httplib
 import json
-import subprocess
-import ConfigParser
-import argparse
 import time
+import threading
+import re
+import math
+from contextlib import contextmanager
 
+# httplib, ssl, subprocess, ConfigParser and the like are imported by the
+# functions that use them, so actions that don't need them start faster.
+
+# urlparse first: probing urllib.parse on python 2 imports urllib, and with it
+# socket and ssl.
 try:
-  from urllib.parse import urlparse
-except:
   from urlparse import urlparse
+except ImportError:
+  from urllib.parse import urlparse
 
-def create_connection(url):
+def create_connection(url, timeout=None, context=None):
+  import httplib
   if url.scheme == 'https':
-    return httplib.HTTPSConnection(url.netloc)
-  return httplib.HTTPConnection(url.netloc or url.path)
+    return httplib.HTTPSConnection(url.netloc, timeout=timeout, context=context)
+  return httplib.HTTPConnection(url.netloc or url.path, timeout=timeout)
+
+LOCK_CONFLICT_STATUSES = (409, 423)
+THROTTLED_STATUSES = (429, 503)
+# Requests a stale connection may have delivered are sent again only with these methods
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+EVENTS_POLL_INTERVAL = 1
+# Seconds an event cursor starts before the estimated tsuru clock, whose Date header has 1s precision
+EVENTS_CLOCK_MARGIN = 1
+# Seconds finished events are kept once the cursor moved past them
+EVENTS_HISTORY = 600
+READINESS_MIN_INTERVAL = 0.5
+READINESS_MAX_INTERVAL = 5
+READY_UNIT_STATUSES = ('started',)
+STATE_DIR = '.tsuru-bluegreen'
+PREWARM_READINESS_TIMEOUT = 600
+DEPLOY_OUTPUT_CHUNK = 64 * 1024
+DEPLOY_TAIL_BYTES_PER_LINE = 1024
+# Environment variables Config.load reads, part of the config cache key.
+CONFIG_CACHE_ENV = ('NEW_RELIC_API_KEY', 'NEW_RELIC_APP_ID')
+DEPLOY_METADATA_KEYS = ['TAG', 'BLUEGREEN_COMMIT', 'BLUEGREEN_BUILD_ID', 'BLUEGREEN_DEPLOYED_AT', 'BLUEGREEN_BUILD_HASH', 'BLUEGREEN_IMAGE']
+BUILD_HASH_CHUNK = 64 * 1024
+HOOK_POLL_INTERVAL = 0.1
+# How many pre and swap steps may run at the same time; unit changes are
+# further bounded by [Scaling] max_workers
+STEP_WORKERS = 4
+# What an app carries about its last build, to skip or promote it
+BUILD_KEYS = ['TAG', 'BLUEGREEN_BUILD_HASH', 'BLUEGREEN_IMAGE']
+DAEMON_LISTEN = '127.0.0.1:8765'
+# Finished jobs the daemon keeps per app for status requests
+DAEMON_JOB_HISTORY = 20
+# A pending drain whose worker recorded no pid within this many seconds never started
+DRAIN_START_TIMEOUT = 60
+DRAIN_POLL_INTERVAL = 2
+# How long pre waits for a background drain of its app before giving up
+DRAIN_WAIT_TIMEOUT = 900
+
+def run_concurrently(tasks, max_workers):
+  """Call every task using at most max_workers threads. Results keep the tasks' order."""
+  if max_workers <= 1 or len(tasks) <= 1:
+    return [task() for task in tasks]
+
+  results = [None] * len(tasks)
+  errors = []
+  slots = threading.BoundedSemaphore(max_workers)
+
+  def worker(index, task):
+    try:
+      results[index] = task()
+    except Exception as e:
+      errors.append(e)
+    finally:
+      slots.release()
+
+  threads = []
+  for index, task in enumerate(tasks):
+    slots.acquire()
+    thread = threading.Thread(target=worker, args=(index, task))
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    raise errors[0]
+  return results
+
+class Step:
+  """One operation of a plan: what it runs, which steps must succeed first and
+  how many tsuru API calls it should take.
+
+  Journaled steps are recorded once done, so a rerun of the plan skips them;
+  restore, if given, gets their recorded result back. A failed rolls_back step
+  has undone the steps before it, so a rerun starts over instead."""
+  def __init__(self, name, func, depends=(), calls=0, description=None, required=True, phase=None,
+               journaled=True, restore=None, rolls_back=False):
+    self.name = name
+    self.func = func
+    self.depends = list(depends)
+    self.calls = calls
+    self.description = description or name
+    self.required = required
+    self.phase = phase
+    self.journaled = journaled
+    self.restore = restore
+    self.rolls_back = rolls_back
+    self.status = 'pending'
+    self.result = None
+    self.error = None
+    self.started = None
+    self.elapsed = None
+
+  @property
+  def succeeded(self):
+    """Whether the steps depending on this one may run. Optional steps never block them."""
+    return self.status == 'done' or (self.status == 'failed' and not self.required)
+
+  def run(self):
+    self.started = time.time()
+    try:
+      self.result = self.func()
+      self.status = 'failed' if self.result is False else 'done'
+    except Exception as e:
+      self.error = e
+      self.status = 'failed'
+    finally:
+      self.elapsed = time.time() - self.started
+
+class Plan:
+  def __init__(self, title, steps):
+    self.title = title
+    self.steps = steps
+    self.journal = None
+
+  @property
+  def calls(self):
+    return sum(step.calls for step in self.steps)
+
+  @property
+  def failed(self):
+    return any(step.required and step.status in ('failed', 'skipped') for step in self.steps)
+
+  def describe(self):
+    lines = ["  %s (~%d tsuru API calls):" % (self.title, self.calls)]
+    for index, step in enumerate(self.steps):
+      notes = []
+      if step.calls:
+        notes.append("~%d calls" % step.calls)
+      if step.depends:
+        notes.append("after %s" % ", ".join(step.depends))
+      if not step.required:
+        notes.append("optional")
+      if step.status == 'done':
+        notes.append("done, skipped on resume")
+      line = "  %2d. [%s] %s" % (index + 1, step.name, step.description)
+      if notes:
+        line += " (%s)" % "; ".join(notes)
+      lines.append(line)
+    return "\n".join(lines)
+
+def run_graph(steps, max_workers, on_finish=None):
+  """Run each step once the steps it depends on succeeded, up to max_workers at a time.
+
+  Steps must come after the steps they depend on. A step fails when it returns
+  False or raises; the steps depending on a failed required step are skipped.
+  Once a step raises no new step starts, and the first error is re-raised.
+  Steps already done are not run again. on_finish, if given, is called with
+  each step that ran, from the calling thread.
+  """
+  by_name = {}
+  for step in steps:
+    for dependency in step.depends:
+      if dependency not in by_name:
+        raise ValueError("Step '%s' depends on '%s', which does not come before it" % (step.name, dependency))
+    by_name[step.name] = step
+
+  # Steps whose thread finished are only looked at once the loop took them back, after their error
+  running = set()
+
+  def blocked(step):
+    return any(dependency not in running and by_name[dependency].status in ('failed', 'skipped') and
+               not by_name[dependency].succeeded for dependency in step.depends)
+
+  def ready(step):
+    return all(dependency not in running and by_name[dependency].succeeded for dependency in step.depends)
+
+  if max_workers <= 1:
+    for step in steps:
+      if step.status == 'done':
+        continue
+      if blocked(step):
+        step.status = 'skipped'
+        continue
+      step.run()
+      if on_finish:
+        on_finish(step)
+      if step.error is not None:
+        raise step.error
+    return steps
+
+  import Queue
+  finished = Queue.Queue()
+  pending = [step for step in steps if step.status != 'done']
+  error = None
+  while pending or running:
+    for step in list(pending):
+      if blocked(step):
+        step.status = 'skipped'
+        pending.remove(step)
+      elif error is None and len(running) < max_workers and ready(step):
+        pending.remove(step)
+        step.status = 'running'
+        running.add(step.name)
+        thread = threading.Thread(target=lambda step=step: (step.run(), finished.put(step)))
+        thread.daemon = True
+        thread.start()
+
+    if not running:
+      break
+    step = finished.get()
+    running.discard(step.name)
+    if on_finish:
+      on_finish(step)
+    if step.error is not None and error is None:
+      error = step.error
+
+  for step in pending:
+    step.status = 'skipped'
+  if error is not None:
+    raise error
+  return steps
+
+def critical_path(steps):
+  """The chain of dependent steps that took the longest, as (seconds, steps)."""
+  paths = {}
+  for step in steps:
+    if step.elapsed is None:
+      continue
+    longest = (0.0, [])
+    for dependency in step.depends:
+      if dependency in paths and paths[dependency][0] > longest[0]:
+        longest = paths[dependency]
+    paths[step.name] = (longest[0] + step.elapsed, longest[1] + [step])
+  if not paths:
+    return 0.0, []
+  return max(paths.values(), key=lambda path: path[0])
+
+def path_template(url):
+  """Strip the query string and app names from an API path, e.g. /apps/{app}/units."""
+  return re.sub(r'^/apps/[^/]+', '/apps/{app}', url.split('?', 1)[0])
+
+class Metrics:
+  """Timings of deploy phases, tsuru API calls, retries, hooks and notifications."""
+  def __init__(self, app_name):
+    self.app_name = app_name
+    self.lock = threading.Lock()
+    self.phases = []
+    self.requests = []
+    self.retries = {}
+    self.hooks = []
+    self.notifications = {}
+    self.stats = {}
+
+  @contextmanager
+  def phase(self, name):
+    started = time.time()
+    try:
+      yield
+    finally:
+      with self.lock:
+        self.phases.append({'name': name, 'elapsed': time.time() - started})
+
+  def record_steps(self, steps):
+    """Record, as one phase each, the time span of the steps sharing a phase."""
+    spans = []
+    for step in steps:
+      if step.phase is None or step.started is None:
+        continue
+      for span in spans:
+        if span[0] == step.phase:
+          span[1] = min(span[1], step.started)
+          span[2] = max(span[2], step.started + step.elapsed)
+          break
+      else:
+        spans.append([step.phase, step.started, step.started + step.elapsed])
+    with self.lock:
+      for name, started, finished in spans:
+        self.phases.append({'name': name, 'elapsed': finished - started})
+
+  def record_request(self, method, url, status, elapsed):
+    with self.lock:
+      self.requests.append({'method': method, 'path': path_template(url), 'status': status, 'elapsed': elapsed})
+
+  def record_retry(self, operation):
+    with self.lock:
+      self.retries[operation] = self.retries.get(operation, 0) + 1
+
+  def record_hook(self, name, succeeded, elapsed):
+    with self.lock:
+      self.hooks.append({'name': name, 'succeeded': succeeded, 'elapsed': elapsed})
+
+  def request_summary(self):
+    """Requests grouped by method, path template and status."""
+    summary = {}
+    for request in self.requests:
+      key = (request['method'], request['path'], request['status'])
+      entry = summary.setdefault(key, {'method': key[0], 'path': key[1], 'status': key[2],
+                                       'count': 0, 'elapsed': 0.0, 'max_elapsed': 0.0})
+      entry['count'] += 1
+      entry['elapsed'] += request['elapsed']
+      entry['max_elapsed'] = max(entry['max_elapsed'], request['elapsed'])
+    return [summary[key] for key in sorted(summary)]
+
+  def report(self):
+    with self.lock:
+      return {
+        'app': self.app_name,
+        'phases': list(self.phases),
+        'requests': self.request_summary(),
+        'retries': dict(self.retries),
+        'hooks': list(self.hooks),
+        'notifications': dict(self.notifications),
+        'stats': dict(self.stats),
+      }
+
+  def write_json(self, path):
+    with open(path, 'w') as report_file:
+      json.dump(self.report(), report_file, indent=2, sort_keys=True)
+
+  def prometheus(self):
+    def escape_label(value):
+      return ('%s' % value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    report = self.report()
+    app = report['app']
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+      lines.append('# HELP tsuru_bluegreen_%s %s' % (name, help_text))
+      lines.append('# TYPE tsuru_bluegreen_%s %s' % (name, kind))
+      for labels, value in samples:
+        labels = dict(labels, app=app)
+        label_text = ','.join('%s="%s"' % (key, escape_label(labels[key])) for key in sorted(labels))
+        lines.append('tsuru_bluegreen_%s{%s} %s' % (name, label_text, repr(float(value))))
+
+    metric('phase_duration_seconds', 'gauge', 'Duration of each deploy phase.',
+           [({'phase': phase['name']}, phase['elapsed']) for phase in report['phases']])
+    metric('http_requests_total', 'counter', 'tsuru API requests.',
+           [({'method': r['method'], 'path': r['path'], 'status': r['status']}, r['count']) for r in report['requests']])
+    metric('http_request_duration_seconds_sum', 'counter', 'Total latency of tsuru API requests.',
+           [({'method': r['method'], 'path': r['path'], 'status': r['status']}, r['elapsed']) for r in report['requests']])
+    metric('retries_total', 'counter', 'Retried operations.',
+           [({'operation': operation}, count) for operation, count in sorted(report['retries'].items())])
+    metric('hook_duration_seconds', 'gauge', 'Duration of each hook.',
+           [({'hook': hook['name'], 'succeeded': str(hook['succeeded']).lower()}, hook['elapsed']) for hook in report['hooks']])
+    metric('notification_duration_seconds', 'gauge', 'Duration of each notification.',
+           [({'notifier': name, 'outcome': value['outcome']}, value['elapsed']) for name, value in sorted(report['notifications'].items())])
+    if 'rate_limit' in report['stats']:
+      metric('throttled_requests_total', 'counter', 'tsuru API requests delayed by the client-side rate limit.',
+             [({}, report['stats']['rate_limit']['throttled'])])
+      metric('throttle_wait_seconds_total', 'counter', 'Time tsuru API requests waited for the client-side rate limit.',
+             [({}, report['stats']['rate_limit']['wait_seconds'])])
+    if 'critical_path' in report['stats']:
+      metric('critical_path_seconds', 'gauge', 'Duration of the longest chain of dependent deploy steps.',
+             [({}, report['stats']['critical_path']['seconds'])])
+    return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self, path):
+    """Write atomically, so the node exporter never reads a partial file."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as textfile:
+      textfile.write(self.prometheus())
+    os.rename(temp_path, path)
+
+def write_state(path, data, mode=None):
+  """Atomically replace a JSON state file, creating its directory if needed.
+  A mode restricts the file permissions before any data is written."""
+  directory = os.path.dirname(path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+  temp_path = path + '.tmp'
+  fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666 if mode is None else mode)
+  if mode is not None:
+    os.fchmod(fd, mode)
+  with os.fdopen(fd, 'w') as state_file:
+    json.dump(data, state_file, indent=2, sort_keys=True)
+  os.rename(temp_path, path)
+
+def process_alive(pid):
+  import errno
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True
+
+def read_state(path):
+  try:
+    with open(path) as state_file:
+      return json.load(state_file)
+  except (IOError, ValueError):
+    return None
+
+def encode_strings(value):
+  """Turn the unicode strings json gives back into the str ConfigParser returns."""
+  if isinstance(value, dict):
+    return dict((encode_strings(key), encode_strings(item)) for key, item in value.items())
+  if isinstance(value, list):
+    return [encode_strings(item) for item in value]
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value
+
+class Task:
+  """Runs a callable in a daemon thread, recording its outcome and duration."""
+  def __init__(self, name, func, *args):
+    self.name = name
+    self.result = None
+    self.error = None
+    self.elapsed = None
+    self.started = None
+    self.thread = threading.Thread(target=self.run, args=(func,) + args)
+    self.thread.daemon = True
+
+  def start(self):
+    self.started = time.time()
+    self.thread.start()
+    return self
+
+  def run(self, func, *args):
+    try:
+      self.result = func(*args)
+    except Exception as e:
+      self.error = e
+    finally:
+      self.elapsed = time.time() - self.started
+
+  def join(self, timeout=None):
+    self.thread.join(timeout)
+    return not self.thread.is_alive()
+
+class Response:
+  """Fully drained HTTP response, so its connection can go back to the pool."""
+  def __init__(self, response, body):
+    self.status = response.status
+    self.reason = response.reason
+    self.headers = response.getheaders()
+    self.body = body
+    self.consumed = False
+
+  def getheader(self, name, default=None):
+    for key, value in self.headers:
+      if key.lower() == name.lower():
+        return value
+    return default
+
+  def read(self):
+    if self.consumed:
+      return ''
+    self.consumed = True
+    return self.body
+
+class ConnectionPool:
+  """Keep-alive connections to a single target, shared by every API call.
+
+  Idle connections are reused, and a reused connection that turns out to be
+  stale (closed by the server or a load balancer) is replaced once by a new
+  one. The request is sent again on it only if it could not be sent, or
+  repeating it is harmless. HTTPS connections share a single SSL context.
+  """
+  def __init__(self, url, size=4, timeout=None):
+    import ssl
+    self.url = url
+    self.size = size
+    self.timeout = timeout
+    self.idle = []
+    self.lock = threading.Lock()
+    self.stats = {'new': 0, 'reused': 0, 'reconnects': 0}
+    self.context = None
+    if url.scheme == 'https':
+      self.context = ssl.create_default_context()
+
+  def connect(self):
+    with self.lock:
+      self.stats['new'] += 1
+    return create_connection(self.url, self.timeout, self.context)
+
+  def acquire(self):
+    with self.lock:
+      if self.idle:
+        self.stats['reused'] += 1
+        return self.idle.pop(), True
+    return self.connect(), False
+
+  def release(self, conn):
+    with self.lock:
+      if len(self.idle) < self.size:
+        self.idle.append(conn)
+        return
+    conn.close()
+
+  def close(self):
+    with self.lock:
+      idle, self.idle = self.idle, []
+    for conn in idle:
+      conn.close()
+
+  def request(self, method, url, body=None, headers=None):
+    import httplib
+    import socket
+    conn, reused = self.acquire()
+    sent = False
+    try:
+      conn.request(method, url, body, headers or {})
+      sent = True
+      response = conn.getresponse()
+    except (socket.error, httplib.HTTPException):
+      conn.close()
+      # The server may have processed a request it got: adding units or swapping twice is not a retry
+      if not reused or (sent and method not in IDEMPOTENT_METHODS):
+        raise
+      with self.lock:
+        self.stats['reconnects'] += 1
+      conn = self.connect()
+      conn.request(method, url, body, headers or {})
+      response = conn.getresponse()
+
+    result = Response(response, response.read())
+    if response.will_close:
+      conn.close()
+    else:
+      self.release(conn)
+    return result
+
+def retry_after(value, default):
+  """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date."""
+  if not value:
+    return default
+  try:
+    return max(0, int(value.strip()))
+  except ValueError:
+    pass
+  import email.utils
+  parsed = email.utils.parsedate_tz(value)
+  if parsed is None:
+    return default
+  return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+def parse_event_time(value):
+  """Seconds since the epoch of an RFC 3339 time, as tsuru gives event times, or None."""
+  import calendar
+  match = re.match(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)$', value or '')
+  if not match:
+    return None
+  seconds = calendar.timegm([int(field) for field in match.groups()[:6]] + [0, 0, 0]) + float(match.group(7) or 0)
+  zone = match.group(8)
+  if zone != 'Z':
+    offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+    seconds += -offset if zone[0] == '+' else offset
+  return seconds
+
+def format_event_time(seconds):
+  return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+def event_data(event, name):
+  """A field of the request tsuru keeps with an event, like the process of a unit change."""
+  for field in event.get('CustomData') or []:
+    if isinstance(field, dict) and field.get('name') == name:
+      return field.get('value')
+  return None
+
+class EventFeed:
+  """Incremental view of the tsuru events of the apps being deployed.
+
+  The first update of an app asks for its running events, or, once start()
+  was called, for the events since then. Later updates ask only for the events
+  started since the oldest one still running, or since the previous update,
+  and merge them by id. An update already made after a given time is shared
+  instead of repeated.
+  """
+  def __init__(self, bluegreen):
+    self.bluegreen = bluegreen
+    self.lock = threading.Lock()
+    self.apps = {}
+
+  def app_state(self, app):
+    with self.lock:
+      if app not in self.apps:
+        self.apps[app] = {'lock': threading.Lock(), 'since': None, 'events': {}, 'seen': {}, 'fetched': None, 'failed': False}
+      return self.apps[app]
+
+  def start(self, app):
+    """Follow app from now on, so updates also return the events that finished in between."""
+    state = self.app_state(app)
+    with state['lock']:
+      if state['since'] is None:
+        state['since'] = self.bluegreen.server_time() - EVENTS_CLOCK_MARGIN
+
+  def update(self, app, after=None):
+    """Fetch the new and changed events of app, unless an update started at or after `after` did."""
+    state = self.app_state(app)
+    with state['lock']:
+      if after is not None and state['fetched'] is not None and state['fetched'] >= after:
+        return
+
+      fetched = time.time()
+      server_time = self.bluegreen.server_time()
+      if state['since'] is None:
+        response = self.bluegreen.get("/events?target.value=" + app + "&running=true")
+      else:
+        response = self.bluegreen.get("/events?target.value=" + app + "&since=" + format_event_time(state['since']))
+      state['fetched'] = fetched
+
+      events = []
+      if response.status != 204:
+        try:
+          events = json.loads(response.read()) or []
+        except ValueError:
+          events = None
+      state['failed'] = response.status not in (200, 204) or events is None
+      if state['failed']:
+        return
+
+      returned = set()
+      for event in events:
+        key = event.get('UniqueID') or json.dumps(event, sort_keys=True)
+        returned.add(key)
+        state['seen'].setdefault(key, fetched)
+        state['events'][key] = event
+      # Running events all started after the cursor, so one missing from the answer has finished
+      for key, event in state['events'].items():
+        if event.get('Running') and key not in returned:
+          state['events'][key] = dict(event, Running=False)
+
+      starts = [parse_event_time(event.get('StartTime')) for event in state['events'].values() if event.get('Running')]
+      if None in starts:
+        state['since'] = None
+        return
+      state['since'] = min(starts + [server_time - EVENTS_CLOCK_MARGIN])
+      for key, event in state['events'].items():
+        start = parse_event_time(event.get('StartTime'))
+        if not event.get('Running') and start is not None and start < state['since'] - EVENTS_HISTORY:
+          del state['events'][key]
+
+  def running(self, app):
+    """Whether app had running events at the last update; True if it could not tell."""
+    state = self.app_state(app)
+    with state['lock']:
+      return state['failed'] or any(event.get('Running') for event in state['events'].values())
+
+  def wait_idle(self, app, timeout):
+    """Wait up to timeout seconds for the running events of app to finish; whether they did."""
+    deadline = time.time() + timeout
+    self.update(app)
+    while self.running(app):
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        return False
+      time.sleep(min(EVENTS_POLL_INTERVAL, remaining))
+      self.update(app)
+    return True
+
+  def completed(self, app, kind, process_name, after):
+    """Outcome of the kind events for process_name first seen after `after`.
+
+    True if they all finished without error, False if one failed, and None if
+    none was seen or one is still running.
+    """
+    state = self.app_state(app)
+    with state['lock']:
+      matching = [event for key, event in state['events'].items()
+                  if state['seen'][key] >= after and (event.get('Kind') or {}).get('Name') == kind and
+                  event_data(event, 'process') == process_name]
+    if not matching or any(event.get('Running') for event in matching):
+      return None
+    return not any(event.get('Error') for event in matching)
+
+class RateLimiter:
+  """Client-side limits on tsuru API calls, shared by every thread using it.
+
+  A token bucket lets through `rate` requests per second on average, in
+  bursts of up to `burst`, and at most `concurrency` requests are in flight.
+  A pause asked for by the server (Retry-After) holds every request. A rate
+  or concurrency of 0 means no limit.
+  """
+  def __init__(self, rate=0, burst=0, concurrency=0):
+    self.rate = rate
+    self.burst = burst or max(1, int(math.ceil(rate)))
+    self.tokens = float(self.burst)
+    self.updated = time.time()
+    self.paused_until = 0
+    self.lock = threading.Lock()
+    self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+    self.stats = {'requests': 0, 'throttled': 0, 'wait_seconds': 0.0, 'pauses': 0}
+
+  def wait_time(self):
+    now = time.time()
+    wait = max(0, self.paused_until - now)
+    if self.rate:
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      if self.tokens < 1:
+        wait = max(wait, (1 - self.tokens) / self.rate)
+    return wait
+
+  def acquire(self):
+    """Wait for a request slot and token. Returns the seconds waited."""
+    started = time.time()
+    if self.slots:
+      self.slots.acquire()
+    while True:
+      with self.lock:
+        wait = self.wait_time()
+        if wait <= 0:
+          if self.rate:
+            self.tokens -= 1
+          waited = time.time() - started
+          self.stats['requests'] += 1
+          if waited >= 0.001:
+            self.stats['throttled'] += 1
+            self.stats['wait_seconds'] += waited
+          return waited
+      time.sleep(wait)
+
+  def release(self):
+    if self.slots:
+      self.slots.release()
+
+  def pause(self, seconds):
+    with self.lock:
+      self.paused_until = max(self.paused_until, time.time() + seconds)
+      self.stats['pauses'] += 1
 
 class BlueGreen:
-  def __init__(self, token, target, config):
+  def __init__(self, token, target, config, limiter=None):
     self.token = token
     self.target = urlparse(target)
+    self.pool = ConnectionPool(self.target)
+    self.metrics = Metrics(config['name'])
+    self.cache_lock = threading.Lock()
+    self.app_cache = {}
+    self.env_cache = {}
+    self.cache_stats = {'hits': 0, 'misses': 0}
+    self.lock_conflict = threading.Event()
+    self.serial_lock = threading.Lock()
+    self.local = threading.local()
+    self.events = EventFeed(self)
+    self.last_response = None
+    self.config = config
+    self.state_dir = STATE_DIR
     self.app_name = config['name']
     self.deploy_dir = config['deploy_dir']
     self.retry_times = config['retry_times']
     self.retry_sleep = config['retry_sleep']
 
+    try:
+      self.retry_max_sleep = config['retry_max_sleep']
+    except KeyError:
+      self.retry_max_sleep = 60
+    try:
+      self.retry_deadline = config['retry_deadline']
+    except KeyError:
+      self.retry_deadline = 0
+
+    try:
+      self.deploy_log = config['deploy_log']
+    except KeyError:
+      self.deploy_log = {'directory': None, 'tail_lines': 100}
+
+    try:
+      self.prewarm = config['prewarm']
+    except KeyError:
+      self.prewarm = False
+    try:
+      self.deploy_strategy = config['deploy_strategy']
+    except KeyError:
+      self.deploy_strategy = 'build'
+
+    try:
+      self.drain_in_background = config['drain_in_background']
+    except KeyError:
+      self.drain_in_background = False
+
+    try:
+      self.max_workers = config['max_workers']
+    except KeyError:
+      self.max_workers = 1
+    self.scale_slots = threading.BoundedSemaphore(max(1, self.max_workers))
+    try:
+      self.readiness_timeout = config['readiness_timeout']
+    except KeyError:
+      self.readiness_timeout = 0
+    try:
+      self.rolling_swap = config['rolling_swap']
+    except KeyError:
+      self.rolling_swap = {'enabled': False, 'max_surplus': 1, 'threshold': 1.0}
+
     try:
       self.hooks = config['hooks']
     except KeyError:
       self.hooks = {}
+    try:
+      self.hook_timeout = config['hook_timeout']
+    except KeyError:
+      self.hook_timeout = 0
     try:
       self.newrelic = config['newrelic']
     except KeyError:
@@ -44,6 +822,35 @@ class BlueGreen:
       self.webhook = config['webhook']
     except KeyError:
       self.webhook = {}
+    try:
+      self.metrics_config = config['metrics']
+    except KeyError:
+      self.metrics_config = {}
+    try:
+      self.notifications = config['notifications']
+    except KeyError:
+      self.notifications = {'timeout': 10, 'join_timeout': 10}
+    try:
+      self.rate_limit = config['rate_limit']
+    except KeyError:
+      self.rate_limit = {'rate': 0, 'burst': 0, 'concurrency': 0, 'max_retries': 3, 'max_wait': 60}
+    self.limiter = limiter or RateLimiter(self.rate_limit['rate'], self.rate_limit['burst'], self.rate_limit['concurrency'])
+
+  def discover(self, refresh=False):
+    """Return [live, pre] apps, plus the cname of the live app."""
+    blue = "%s-blue" % self.app_name
+    green = "%s-green" % self.app_name
+
+    apps = [blue, green]
+    self.prefetch(apps, refresh)
+    cnames = [self.get_cname(green), self.get_cname(blue)]
+
+    #reverse if first is not None
+    if cnames[0] is not None:
+      cnames.reverse()
+      apps.reverse()
+
+    return apps, cnames[1]
 
   def remove_cname(self, app, cname):
     query = ""
@@ -52,6 +859,7 @@ class BlueGreen:
     query = query[:-1]
 
     response = self.delete("/apps/{}/cname?{}".format(app, query))
+    self.invalidate(app)
     return response.status == 200
 
   def set_cname(self, app, cname):
@@ -60,62 +868,173 @@ class BlueGreen:
     for val in cname:
       body += "cname={}&".format(val)
     body = body[:-1]
-    return self.post(url, body)
+    result = self.post(url, body)
+    self.invalidate(app)
+    return result
 
   def get_cname(self, app):
-    response = self.get("/apps/{}".format(app))
-    data = json.loads(response.read())
+    data = self.app_info(app)
     if len(data.get("cname")) == 0:
       return None
     return data.get("cname")
 
+  def cached(self, cache, key):
+    with self.cache_lock:
+      if key in cache:
+        self.cache_stats['hits'] += 1
+        return True, cache[key]
+      self.cache_stats['misses'] += 1
+      return False, None
+
+  def app_info(self, app, refresh=False):
+    """Snapshot of GET /apps/{app}, kept until one of our own calls changes the app."""
+    if not refresh:
+      found, data = self.cached(self.app_cache, app)
+      if found:
+        return data
+
+    response = self.get("/apps/{}".format(app))
+    data = json.loads(response.read())
+    if response.status == 200:
+      with self.cache_lock:
+        self.app_cache[app] = data
+    return data
+
+  def prefetch(self, apps, refresh=False):
+    """Fetch the snapshots of several apps concurrently."""
+    return run_concurrently([lambda app=app: self.app_info(app, refresh) for app in apps], len(apps))
+
+  def invalidate(self, app, envs_only=False):
+    with self.cache_lock:
+      if not envs_only:
+        self.app_cache.pop(app, None)
+      for key in self.env_cache.keys():
+        if key[0] == app:
+          del self.env_cache[key]
+
+  def clear_cache(self):
+    with self.cache_lock:
+      self.app_cache.clear()
+      self.env_cache.clear()
+
+  def request(self, method, url, body=None, headers=None):
+    request_headers = {
+      "Authorization": "bearer " + self.token,
+    }
+    request_headers.update(headers or {})
+    max_retries = self.rate_limit['max_retries']
+    for attempt in range(max_retries + 1):
+      self.limiter.acquire()
+      started = time.time()
+      try:
+        response = self.pool.request(method, url, body, request_headers)
+      except Exception:
+        self.metrics.record_request(method, url, 'error', time.time() - started)
+        raise
+      finally:
+        self.limiter.release()
+      self.metrics.record_request(method, url, response.status, time.time() - started)
+      self.last_response = (response, time.time())
+
+      if response.status not in THROTTLED_STATUSES or attempt == max_retries:
+        break
+      delay = min(self.rate_limit['max_wait'], retry_after(response.getheader('retry-after'), 2 ** attempt))
+      print "  tsuru API answered %d to %s %s, retrying in %.1fs ..." % (response.status, method, path_template(url), delay)
+      self.metrics.record_retry('throttled')
+      self.limiter.pause(delay)
+
+    if response.status in LOCK_CONFLICT_STATUSES:
+      self.local.conflict = True
+      self.lock_conflict.set()
+    return response
+
+  def server_time(self):
+    """Estimate of the tsuru API clock, from the Date header of the last response."""
+    if not self.last_response:
+      return time.time()
+    import email.utils
+    response, received = self.last_response
+    parsed = email.utils.parsedate_tz(response.getheader('date') or '')
+    if parsed is None:
+      return time.time()
+    return email.utils.mktime_tz(parsed) + (time.time() - received)
+
   def post(self, url, body):
     headers = {
-      "Authorization": "bearer " + self.token,
       "Content-Type": "application/x-www-form-urlencoded",
     }
-    conn = create_connection(self.target)
-    conn.request("POST", url, body, headers)
-    response = conn.getresponse()
+    response = self.request("POST", url, body, headers)
     return response.status == 200
 
   def get(self, url):
-    headers = {
-      "Authorization": "bearer " + self.token,
-    }
-    conn = create_connection(self.target)
-    conn.request("GET", url, None, headers)
-    return conn.getresponse()
+    return self.request("GET", url)
 
   def delete(self, url):
-    headers = {
-      "Authorization": "bearer " + self.token,
-    }
-    conn = create_connection(self.target)
-    conn.request("DELETE", url, None, headers)
-    return conn.getresponse()
+    return self.request("DELETE", url)
+
+  def put(self, url):
+    return self.request("PUT", url, '')
 
   def swap(self, app1, app2, force=True):
     url = "/swap"
     body = "app1={}&app2={}&force={}&cnameOnly=true".format(app1, app2, str(force).lower())
-    return self.post(url, body)
+    result = self.post(url, body)
+    self.invalidate(app1)
+    self.invalidate(app2)
+    return result
 
   def env_set(self, app, key, value):
+    return self.env_set_many(app, {key: value})
+
+  def env_set_many(self, app, envs):
+    """Set several environment variables with a single request."""
+    import urllib
     url = "/apps/{}/env".format(app)
-    body =  "noRestart=true&Envs.0.Name={}&Envs.0.Value={}".format(key, value)
-    return self.post(url, body)
+    params = [("noRestart", "true")]
+    for index, key in enumerate(sorted(envs)):
+      params.append(("Envs.%d.Name" % index, key))
+      params.append(("Envs.%d.Value" % index, envs[key]))
+    result = self.post(url, urllib.urlencode(params))
+    self.invalidate(app, envs_only=True)
+    return result
 
   def env_get(self, app, key):
-    url = "/apps/{}/env?env={}".format(app, key)
-    response = self.get(url)
-    data = json.loads(response.read())
-    if data is None or len(data) == 0:
-      return None
-    return data[0].get("value")
+    return self.env_get_many(app, [key])[key]
+
+  def env_get_many(self, app, keys):
+    """Get several environment variables, fetching the ones not cached with a single request.
+
+    Returns a dict with every key; missing variables are None.
+    """
+    import urllib
+    values = {}
+    missing = []
+    for key in keys:
+      found, value = self.cached(self.env_cache, (app, key))
+      if found:
+        values[key] = value
+      else:
+        missing.append(key)
+
+    if missing:
+      url = "/apps/{}/env?{}".format(app, urllib.urlencode([("env", key) for key in missing]))
+      response = self.get(url)
+      data = json.loads(response.read()) or []
+      fetched = dict((key, None) for key in missing)
+      for env in data:
+        if env.get("name") in fetched:
+          fetched[env["name"]] = env.get("value")
+
+      values.update(fetched)
+      if response.status == 200:
+        with self.cache_lock:
+          for key, value in fetched.iteritems():
+            self.env_cache[(app, key)] = value
+
+    return values
 
   def total_units(self, app):
-    response = self.get("/apps/{}".format(app))
-    data = json.loads(response.read())
+    data = self.app_info(app)
 
     units = {}
     for unit in data.get('units'):
@@ -127,46 +1046,197 @@ class BlueGreen:
 
     return units
 
+  def lock_aware(self, operation):
+    """Wrap a scaling operation so it runs alone once tsuru reports the app is
+    locked, and is tried once more if the lock made it fail."""
+    def run():
+      if self.lock_conflict.is_set():
+        with self.serial_lock:
+          return operation()
+
+      self.local.conflict = False
+      result = operation()
+      if not result and self.local.conflict:
+        with self.serial_lock:
+          return operation()
+      return result
+    return run
+
+  def scale(self, operations):
+    """Run per process type scaling operations, up to max_workers at a time.
+
+    Operations run concurrently until tsuru reports the app is locked. From
+    then on they run one at a time, and an operation that failed because of
+    the lock is tried once more.
+    """
+    if self.max_workers <= 1:
+      return [operation() for operation in operations]
+    return run_concurrently([self.lock_aware(operation) for operation in operations], self.max_workers)
+
+  def units_readiness(self, app):
+    """Map each process type to whether all of its units are started, from a fresh app snapshot."""
+    data = self.app_info(app, refresh=True)
+    readiness = {}
+    for unit in data.get('units') or []:
+      ready = unit.get('Status') in READY_UNIT_STATUSES
+      readiness[unit['ProcessName']] = readiness.get(unit['ProcessName'], True) and ready
+    return readiness
+
+  def wait_units_ready(self, app, timeout):
+    """Poll app units until every process type is started, backing off between polls.
+
+    Returns the seconds each process type took to become ready, or None if
+    some of them were not ready after timeout seconds.
+    """
+    print """
+  Waiting for %s units to start ...""" % app
+
+    started = time.time()
+    interval = READINESS_MIN_INTERVAL
+    ready_after = {}
+    while True:
+      readiness = self.units_readiness(app)
+      for process_name, ready in readiness.iteritems():
+        if ready and process_name not in ready_after:
+          ready_after[process_name] = time.time() - started
+          print "  '%s' units of %s ready in %.1fs" % (process_name, app, ready_after[process_name])
+
+      pending = [process_name for process_name in readiness if process_name not in ready_after]
+      if not pending:
+        return ready_after
+
+      remaining = started + timeout - time.time()
+      if remaining <= 0:
+        print "  Timed out waiting for '%s' units of %s to start." % ("', '".join(sorted(pending)), app)
+        return None
+
+      # A running event of the app, like a unit change, ends the wait as soon as it finishes
+      if self.events.running(app):
+        self.events.wait_idle(app, min(interval, remaining))
+      else:
+        time.sleep(min(interval, remaining))
+      interval = min(READINESS_MAX_INTERVAL, interval * 1.5)
+
   def remove_units(self, app, units_to_keep=0):
       total_units = self.total_units(app)
-      results = []
+      operations = []
       for process_name, units in total_units.iteritems():
-          results.append(self.remove_units_per_process_type(app, units - units_to_keep, process_name))
+          operations.append(lambda units=units, process_name=process_name:
+                            self.remove_units_per_process_type(app, units - units_to_keep, process_name))
 
+      results = self.scale(operations)
       for result in results:
           if not result:
               return False
 
       return True
 
+  def drain_state_path(self, app):
+    return os.path.join(self.state_dir, 'drain-%s.json' % app)
+
+  def start_drain(self, app):
+    """Hand the removal of all units of app to a detached worker process."""
+    import subprocess
+    if self.drain_running(app):
+      print """
+  Units of %s are already being removed in background.""" % app
+      return self.drain_status(app).get('pid')
+
+    state_path = self.drain_state_path(app)
+    # Only what removing units needs; credentials of notifiers stay out of the state file
+    config = dict((key, value) for key, value in self.config.items()
+                  if key not in ('hooks', 'newrelic', 'grafana', 'webhook'))
+    write_state(state_path, {'app': app, 'state': 'pending', 'started_at': time.time(), 'config': config})
+
+    log = open(os.path.join(self.state_dir, 'drain-%s.log' % app), 'a')
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'drain', '--app', app],
+                               stdin=open(os.devnull), stdout=log, stderr=subprocess.STDOUT,
+                               close_fds=True, preexec_fn=os.setsid)
+    print """
+  Removing %s units in background (pid %d). Run 'tsuru bluegreen drain-status' to follow it.""" % (app, process.pid)
+    return process.pid
+
+  def drain(self, app):
+    """Remove all units of app, recording progress in its drain state file. Run by the detached worker."""
+    state_path = self.drain_state_path(app)
+    state = read_state(state_path) or {'app': app, 'started_at': time.time()}
+    state.update({'state': 'running', 'pid': os.getpid(), 'units': self.total_units(app)})
+    write_state(state_path, state)
+
+    succeeded = self.remove_units(app)
+
+    self.invalidate(app)
+    state.update({'state': 'done' if succeeded else 'failed', 'finished_at': time.time(),
+                  'units': self.total_units(app)})
+    write_state(state_path, state)
+    return succeeded
+
+  def drain_status(self, app):
+    state = read_state(self.drain_state_path(app))
+    if state is None:
+      return None
+    state.pop('config', None)
+    return state
+
+  def drain_running(self, app):
+    """Whether a background drain may still be removing units of app."""
+    state = self.drain_status(app)
+    if state is None or state['state'] not in ('pending', 'running'):
+      return False
+    if state.get('pid'):
+      return process_alive(state['pid'])
+    # The worker records its pid once it starts
+    return time.time() - state.get('started_at', 0) < DRAIN_START_TIMEOUT
+
+  def wait_for_drain(self, app, timeout=DRAIN_WAIT_TIMEOUT):
+    """Wait up to timeout seconds for a background drain of app to finish. False if it didn't."""
+    deadline = time.time() + timeout
+    while self.drain_running(app):
+      if time.time() >= deadline:
+        return False
+      time.sleep(min(DRAIN_POLL_INTERVAL, max(0, deadline - time.time())))
+    return True
+
+  def print_drain_status(self):
+    for color in ['blue', 'green']:
+      app = "%s-%s" % (self.app_name, color)
+      state = self.drain_status(app)
+      if state is not None:
+        print "  %s: %s, units: %s" % (app, state['state'], json.dumps(state.get('units')))
+
   def remove_units_per_process_type(self, app, units_to_remove, process_name):
     print """
   Removing %s '%s' units from %s ...""" % (units_to_remove, process_name, app)
 
-    headers = {"Authorization" : "bearer " + self.token}
-    conn = create_connection(self.target)
-    conn.request("DELETE", "/apps/" + app + '/units?units=' + str(units_to_remove) + '&process=' + process_name, '', headers)
-    response = conn.getresponse()
+    url = "/apps/" + app + '/units?units=' + str(units_to_remove) + '&process=' + process_name
+    self.events.start(app)
+    requested = time.time()
+    response = self.request("DELETE", url, '')
+    self.invalidate(app)
 
     if response.status != 200:
-      response.read() # Flush buffer
-      conn.request("GET", "/events?target.value=" + app + "&running=true", '', headers)
-      response = conn.getresponse()
-      if response.status == 200:
-        print """
-    There's a running event for this app. Wait for the plugin's configured removal retries."""
+      deadline = None
+      if self.retry_deadline:
+        deadline = time.time() + self.retry_deadline
 
       try_times = self.retry_times + 1
       for i in range(1, try_times):
-        response.read() # Flush buffer
+        if deadline and time.time() >= deadline:
+          break
+
         print """
     Error removing '%s' units from %s. Retrying %d...""" % (process_name, app, i)
+        self.metrics.record_retry('remove_units')
 
-        time.sleep(self.retry_sleep)
-        conn.request("DELETE", "/apps/" + app + '/units?units=' + str(units_to_remove) + '&process=' + process_name, '', headers)
-        response = conn.getresponse()
+        self.wait_for_running_events(app, i, deadline)
+        # A removal that went through despite its error answer shows up as a finished event
+        if self.events.completed(app, 'app.update.unit.remove', process_name, requested):
+          response = None
+        else:
+          response = self.request("DELETE", url, '')
+          self.invalidate(app)
 
-        if response.status == 200:
+        if response is None or response.status == 200:
           print """
         Successfully removed '%s' unit from %s""" % (process_name, app)
           return True
@@ -177,9 +1247,37 @@ class BlueGreen:
 
     return True
 
+  def has_running_events(self, app):
+    self.events.update(app)
+    return self.events.running(app)
+
+  def backoff_delay(self, attempt):
+    """Exponential backoff starting at retry_sleep, capped at retry_max_sleep, with jitter."""
+    import random
+    delay = min(self.retry_max_sleep, self.retry_sleep * 2 ** (attempt - 1))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+  def wait_for_running_events(self, app, attempt, deadline=None):
+    """Wait the backoff delay for this attempt, cut short when a running event of the app finishes."""
+    wait_until = time.time() + self.backoff_delay(attempt)
+    if deadline:
+      wait_until = min(wait_until, deadline)
+
+    # Without a running event to watch, the failure may have any cause; back off in full
+    if not self.has_running_events(app):
+      time.sleep(max(0, wait_until - time.time()))
+      return
+
+    print """
+    There's a running event for this app. Waiting for it to finish..."""
+    while time.time() < wait_until:
+      time.sleep(min(EVENTS_POLL_INTERVAL, max(0, wait_until - time.time())))
+      if not self.has_running_events(app):
+        return
+
   def add_units(self, app, total_units_after_add):
     total_units = self.total_units(app)
-    results = []
+    operations = []
     for process_name, units in total_units_after_add.iteritems():
       if total_units.has_key(process_name):
         units_to_add = units - total_units[process_name]
@@ -187,8 +1285,10 @@ class BlueGreen:
         units_to_add = units
 
       if units_to_add > 0:
-        results.append(self.add_units_per_process_type(app, units_to_add, units, process_name))
+        operations.append(lambda units_to_add=units_to_add, units=units, process_name=process_name:
+                          self.add_units_per_process_type(app, units_to_add, units, process_name))
 
+    results = self.scale(operations)
     for result in results:
       if not result:
         return False
@@ -199,21 +1299,76 @@ class BlueGreen:
     print """
   Adding %s '%s' units to %s ...""" % (units_to_add, process_name, app)
 
-    headers = {"Authorization" : "bearer " + self.token}
-    conn = create_connection(self.target)
-    conn.request("PUT", "/apps/" + app + '/units?units=' + str(units_to_add) + '&process=' + process_name, '', headers)
-    response = conn.getresponse()
-    response.read()
+    self.events.start(app)
+    requested = time.time()
+    response = self.put("/apps/" + app + '/units?units=' + str(units_to_add) + '&process=' + process_name)
+    self.invalidate(app)
     if response.status != 200:
       print "Error adding '%s' units to %s. Aborting..." % (process_name, app)
       return False
 
-    if (self.total_units(app)[process_name] != total_units_after_add):
+    # The unit add event tells whether the units were added; the whole app is fetched only if it can't
+    self.events.update(app, time.time())
+    added = self.events.completed(app, 'app.update.unit.add', process_name, requested)
+    if added is False or (added is None and self.total_units(app).get(process_name) != total_units_after_add):
       print "Error adding '%s' units to %s. Aborting..." % (process_name, app)
       return False
     return True
 
+  def roll_units(self, pre, old, target, goal, old_to_keep):
+    """Grow pre towards goal units and shrink old in steps, per process type.
+
+    Units of old are removed only while pre + old stays at or above target,
+    and at most max_surplus units above target are added before waiting for
+    them to start, so the two apps never use more than target + max_surplus
+    units together.
+    """
+    max_surplus = max(1, self.rolling_swap['max_surplus'])
+    while True:
+      pre_units = self.total_units(pre)
+      old_units = self.total_units(old)
+      removals = {}
+      for process_name, units in target.iteritems():
+        pre_count = pre_units.get(process_name, 0)
+        old_count = old_units.get(process_name, 0)
+        to_remove = min(pre_count + old_count - units, old_count - old_to_keep)
+        if to_remove > 0:
+          removals[process_name] = to_remove
+          old_units[process_name] = old_count - to_remove
+
+      additions = {}
+      for process_name, units in target.iteritems():
+        pre_count = pre_units.get(process_name, 0)
+        room = units + max_surplus - pre_count - old_units.get(process_name, 0)
+        to_add = min(goal[process_name] - pre_count, room)
+        if to_add > 0:
+          additions[process_name] = (to_add, pre_count + to_add)
+
+      if not removals and not additions:
+        return all(pre_units.get(process_name, 0) >= units for process_name, units in goal.iteritems())
+
+      print """
+  Rolling %s into %s: removing %s, adding %s""" % (old, pre, json.dumps(removals, sort_keys=True),
+                                                   json.dumps(dict((name, count) for name, (count, _) in additions.items()),
+                                                              sort_keys=True))
+
+      operations = [lambda units=units, process_name=process_name:
+                    self.remove_units_per_process_type(old, units, process_name)
+                    for process_name, units in removals.iteritems()]
+      if not all(self.scale(operations)):
+        return False
+
+      operations = [lambda to_add=to_add, total=total, process_name=process_name:
+                    self.add_units_per_process_type(pre, to_add, total, process_name)
+                    for process_name, (to_add, total) in additions.iteritems()]
+      if not all(self.scale(operations)):
+        return False
+
+      if additions and self.wait_units_ready(pre, self.readiness_timeout or PREWARM_READINESS_TIMEOUT) is None:
+        return False
+
   def notify_newrelic(self,  tag):
+    import httplib
     api_key = self.newrelic.get('api_key')
     app_id = self.newrelic.get('app_id')
     if api_key and app_id:
@@ -224,13 +1379,14 @@ class BlueGreen:
       url = "/v2/applications/" + app_id + "/deployments.json"
       body = 'deployment[application_id]=' + app_id + '&deployment[revision]=' + tag
 
-      conn = httplib.HTTPConnection("api.newrelic.com")
+      conn = httplib.HTTPConnection("api.newrelic.com", timeout=self.notifications['timeout'])
       conn.request("POST", url, body, headers)
       response = conn.getresponse()
       return response.status == 200
     return False
 
   def notify_grafana(self, app, tag):
+    import httplib
     endpoint = self.grafana.get('endpoint')
     index = self.grafana.get('index')
 
@@ -249,12 +1405,13 @@ class BlueGreen:
         "label": tag
       }
 
-      conn = httplib.HTTPConnection(endpoint_host)
+      conn = httplib.HTTPConnection(endpoint_host, timeout=self.notifications['timeout'])
       conn.request("POST", (endpoint_path or '/'), json.dumps(payload), headers)
       response = conn.getresponse()
       return response.status == 200
 
   def run_webhook(self, tag):
+    import httplib
     endpoint = self.webhook.get('endpoint')
     payload_extras = self.webhook.get('payload_extras')
     if endpoint and payload_extras:
@@ -264,18 +1421,123 @@ class BlueGreen:
       endpoint_host = urlparse(endpoint).hostname
       endpoint_path = urlparse(endpoint).path
       headers = {"Content-Type" : "application/x-www-form-urlencoded"}
-      conn = httplib.HTTPConnection(endpoint_host)
+      conn = httplib.HTTPConnection(endpoint_host, timeout=self.notifications['timeout'])
       conn.request("POST", (endpoint_path or '/'), payload_extras + '&tag=' + tag, headers)
       response = conn.getresponse()
       return response.status == 200
     return False
 
+  def notifiers(self, app, tag):
+    """The configured notifiers, as (name, function, arguments)."""
+    notifiers = []
+    if self.newrelic.get('api_key') and self.newrelic.get('app_id'):
+      notifiers.append(('New Relic', self.notify_newrelic, (tag,)))
+    if self.grafana.get('endpoint') and self.grafana.get('index'):
+      notifiers.append(('Grafana', self.notify_grafana, (app, tag)))
+    if self.webhook.get('endpoint') and self.webhook.get('payload_extras'):
+      notifiers.append(('WebHook', self.run_webhook, (tag,)))
+    return notifiers
+
+  def start_notifications(self, app, tag):
+    """Start the configured notifiers only, so failed outcomes are real failures."""
+    return [Task(name, func, *args).start() for name, func, args in self.notifiers(app, tag)]
+
+  def join_notifications(self, tasks, timeout=None):
+    """Wait up to timeout seconds for all notifiers, then report how each one went."""
+    if timeout is None:
+      timeout = self.notifications['join_timeout']
+    deadline = time.time() + timeout
+
+    import socket
+    report = {}
+    for task in tasks:
+      # The outcome is one of a fixed set, so it can label metrics
+      error = None
+      if not task.join(max(0, deadline - time.time())):
+        outcome = 'timeout'
+        elapsed = time.time() - task.started
+      else:
+        elapsed = task.elapsed
+        if isinstance(task.error, socket.timeout):
+          outcome, error = 'timeout', str(task.error)
+        elif task.error is not None:
+          outcome, error = 'error', str(task.error)
+        elif task.result:
+          outcome = 'ok'
+        else:
+          outcome = 'failed'
+      report[task.name] = {'outcome': outcome, 'elapsed': elapsed}
+      if error is not None:
+        report[task.name]['error'] = error
+        print "  %s notification: %s: %s (%.2fs)" % (task.name, outcome, error, elapsed)
+      else:
+        print "  %s notification: %s (%.2fs)" % (task.name, outcome, elapsed)
+
+    self.metrics.notifications.update(report)
+    return report
+
   def run_command(self, command, env_vars=None):
+    return self.run_commands([command], env_vars)
+
+  def run_commands(self, commands, env_vars=None, timeout=0, label=None):
+    """Run commands concurrently, each for at most timeout seconds (0 for no limit).
+
+    A command starting with '-' is optional: its failure is reported but
+    doesn't fail the others. As soon as a required command fails, the ones
+    still running are killed and False is returned.
+    """
+    import shlex
+    import signal
+    import subprocess
+
+    def stop(entry):
+      try:
+        os.killpg(entry['process'].pid, signal.SIGKILL)
+      except OSError:
+        pass
+      entry['process'].wait()
+
+    def report(entry, outcome):
+      if label:
+        print "  [%s] %s: %s in %.1fs" % (label, entry['command'], outcome, time.time() - entry['started'])
+
+    running = []
+    succeeded = True
     try:
-      return_value = subprocess.call(command.split(' '), env=env_vars)
-      return return_value == 0
-    except:
-      return False
+      for line in commands:
+        optional = line.startswith('-')
+        entry = {'command': line[1:].strip() if optional else line, 'optional': optional, 'started': time.time()}
+        try:
+          entry['process'] = subprocess.Popen(shlex.split(entry['command']), env=env_vars, preexec_fn=os.setpgrp)
+          running.append(entry)
+        except (OSError, ValueError, TypeError) as e:
+          report(entry, 'failed to start (%s)' % e)
+          succeeded = succeeded and optional
+
+      while running and succeeded:
+        for entry in list(running):
+          returncode = entry['process'].poll()
+          if returncode is None and timeout and time.time() - entry['started'] >= timeout:
+            stop(entry)
+            outcome = 'timed out'
+          elif returncode is None:
+            continue
+          else:
+            outcome = 'exit %d' % returncode
+
+          running.remove(entry)
+          report(entry, outcome + (' (optional)' if entry['optional'] else ''))
+          if outcome != 'exit 0' and not entry['optional']:
+            succeeded = False
+            break
+
+        if running and succeeded:
+          time.sleep(HOOK_POLL_INTERVAL)
+    finally:
+      for entry in running:
+        stop(entry)
+        report(entry, 'killed')
+    return succeeded
 
   def run_hook(self, hook_name, env_vars=None):
     hook_command = self.hooks.get(hook_name)
@@ -283,98 +1545,930 @@ class BlueGreen:
       print """
   Running '%s' hook ...
       """ % (hook_name)
-      return self.run_command(hook_command, env_vars)
+      commands = [line.strip() for line in hook_command.splitlines() if line.strip()]
+      started = time.time()
+      succeeded = self.run_commands(commands, env_vars, self.hook_timeout, hook_name)
+      self.metrics.record_hook(hook_name, succeeded, time.time() - started)
+      return succeeded
 
     return True
 
-  def deploy_pre(self, app, tag, app_deploy):
+  def export_metrics(self):
+    """Write the metrics report to the paths set in the [Metrics] section, if any."""
+    self.metrics.stats.update({
+      'connections': dict(self.pool.stats),
+      'cache': dict(self.cache_stats),
+      'rate_limit': dict(self.limiter.stats),
+    })
+    json_report = self.metrics_config.get('json_report')
+    if json_report:
+      self.metrics.write_json(json_report.format(app=self.app_name))
+    prometheus_textfile = self.metrics_config.get('prometheus_textfile')
+    if prometheus_textfile:
+      self.metrics.write_prometheus(prometheus_textfile.format(app=self.app_name))
+
+  def prewarm_units(self, app, live):
+    """Scale app to the live app's units and wait for them to start."""
     print """
-  Pre deploying tag:%s to %s ...
-    """ % (tag, app)
-
-    self.remove_units(app)
-
-    self.env_set(app, 'TAG', tag)
+  Pre-warming %s with the units of %s ...""" % (app, live)
 
-    if not self.run_hook('before_pre', {"TAG": tag}):
+    if not self.add_units(app, self.total_units(live)):
+      return False
+    return self.wait_units_ready(app, self.readiness_timeout or PREWARM_READINESS_TIMEOUT) is not None
+
+  def stream_deploy_output(self, process, log_path, tail_lines):
+    """Pass the deploy output through in large chunks, compressing a copy of it
+    to log_path and keeping only a bounded tail in memory.
+
+    Returns the last tail_lines lines of the output.
+    """
+    import collections
+    import gzip
+    tail_lines = max(1, tail_lines)
+    tail = collections.deque()
+    tail_size = 0
+    tail_budget = tail_lines * DEPLOY_TAIL_BYTES_PER_LINE
+
+    log = gzip.open(log_path, 'wb')
+    try:
+      fd = process.stdout.fileno()
+      while True:
+        chunk = os.read(fd, DEPLOY_OUTPUT_CHUNK)
+        if not chunk:
+          break
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+        log.write(chunk)
+
+        tail.append(chunk)
+        tail_size += len(chunk)
+        while len(tail) > 1 and tail_size - len(tail[0]) >= tail_budget:
+          tail_size -= len(tail.popleft())
+    finally:
+      log.close()
+
+    process.wait()
+    return ''.join(tail).splitlines()[-tail_lines:]
+
+  def run_deploy(self, deploy_arguments, app, tag):
+    import subprocess
+    directory = self.deploy_log['directory']
+    if not directory:
+      process = subprocess.Popen(deploy_arguments, stdout=subprocess.PIPE)
+      for line in iter(process.stdout.readline, ''):
+        sys.stdout.write(line)
+
+      process.communicate()
+      return process.returncode
+
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    log_path = os.path.join(directory, '%s-%s-%s.log.gz' % (app, tag.replace('/', '_'), time.strftime('%Y%m%d%H%M%S')))
+
+    process = subprocess.Popen(deploy_arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    tail = self.stream_deploy_output(process, log_path, self.deploy_log['tail_lines'])
+
+    if process.returncode != 0:
+      print """
+  Deploy failed. Last %d lines of its output (full log at %s):
+""" % (len(tail), log_path)
+      print '\n'.join(tail)
+    return process.returncode
+
+  def deploy_metadata(self, tag):
+    """Variables stamped on the pre app to describe what was deployed to it."""
+    import subprocess
+    metadata = {
+      'TAG': tag,
+      'BLUEGREEN_DEPLOYED_AT': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    try:
+      devnull = open(os.devnull, 'w')
+      commit = subprocess.check_output(['git', 'rev-parse', '--verify', '-q', '%s^{commit}' % tag], stderr=devnull)
+      metadata['BLUEGREEN_COMMIT'] = commit.strip()
+    except Exception:
+      pass
+    if os.environ.get('BUILD_ID'):
+      metadata['BLUEGREEN_BUILD_ID'] = os.environ['BUILD_ID']
+    return metadata
+
+  def build_hash(self, tag, app_deploy, metadata):
+    """Identify what a deploy would ship: the commit pushed by git deploys, or
+    the contents of deploy_dir for app-deploy. None when it can't be told."""
+    if not app_deploy:
+      commit = metadata.get('BLUEGREEN_COMMIT')
+      return 'git:' + commit if commit else None
+
+    import hashlib
+    files = []
+    for path in self.deploy_dir.split():
+      if os.path.isfile(path):
+        files.append(path)
+      elif os.path.isdir(path):
+        for root, directories, filenames in os.walk(path):
+          directories[:] = sorted(directory for directory in directories if directory != '.git')
+          files.extend(os.path.join(root, filename) for filename in filenames)
+      else:
+        return None
+
+    digest = hashlib.sha1()
+    for path in sorted(files):
+      mode = os.stat(path).st_mode
+      digest.update('%s\0%d\0%d\0' % (path, mode & 0111, os.path.getsize(path)))
+      with open(path, 'rb') as content:
+        for chunk in iter(lambda: content.read(BUILD_HASH_CHUNK), ''):
+          digest.update(chunk)
+    return 'sha1:' + digest.hexdigest()
+
+  def latest_image(self, app):
+    """The image of the last deploy of app, or None."""
+    response = self.get("/deploys?app={}&limit=1".format(app))
+    if response.status != 200:
+      return None
+    try:
+      deploys = json.loads(response.read())
+    except ValueError:
+      return None
+    if not deploys:
+      return None
+    return deploys[0].get('Image') or None
+
+  def find_image(self, tag, build_hash, states):
+    """An image already built for tag (and build_hash, when known) on one of the apps."""
+    for state in states:
+      if state['TAG'] != tag or not state['BLUEGREEN_IMAGE']:
+        continue
+      if build_hash is None or state['BLUEGREEN_BUILD_HASH'] == build_hash:
+        return state['BLUEGREEN_IMAGE']
+    return None
+
+  def plan_pre(self, app, tag, app_deploy, live=None, force=False):
+    """Plan the steps deploying tag to the pre app.
+
+    Reading the app state, resolving the tag commit and hashing deploy_dir run
+    together. Unit removal, the env write and the before_pre hook then run
+    together too, and the deploy waits for all of them.
+    """
+    promote = self.deploy_strategy == 'promote'
+    state = {'metadata': None, 'build_hash': None, 'states': [], 'skip': False, 'status': None}
+    steps = []
+
+    def metadata():
+      state['metadata'] = self.deploy_metadata(tag)
+    steps.append(Step('metadata', metadata, journaled=False, description="resolve the commit of tag:%s" % tag))
+
+    def build_hash():
+      state['build_hash'] = self.build_hash(tag, app_deploy, state['metadata'])
+    steps.append(Step('build_hash', build_hash, ['metadata'], journaled=False,
+                      description="hash %s" % (self.deploy_dir if app_deploy else "the tag commit")))
+
+    apps = [app] + ([live] if promote and live else [])
+    if promote or not force:
+      def read_state():
+        with self.metrics.phase('read_state'):
+          state['states'] = run_concurrently([lambda name=name: self.env_get_many(name, BUILD_KEYS) for name in apps], 2)
+      steps.append(Step('read_state', read_state, calls=len(apps), journaled=False,
+                        description="read the builds of %s" % ", ".join(apps)))
+
+    if self.drain_running(app):
+      # A drain still running would remove the units the deploy starts
+      def wait_drain():
+        print """
+  Waiting for the background removal of %s units ...""" % app
+        if not self.wait_for_drain(app):
+          print """
+  Units of %s are still being removed after %ds. Pre deploy aborted.
+          """ % (app, DRAIN_WAIT_TIMEOUT)
+          return False
+      steps.append(Step('wait_drain', wait_drain, journaled=False,
+                        description="wait for the background removal of %s units" % app))
+
+    def check_build():
+      deployed = state['states'][0] if state['states'] else {}
+      if (state['build_hash'] and not force and deployed.get('TAG') == tag and
+          deployed.get('BLUEGREEN_BUILD_HASH') == state['build_hash']):
+        state['skip'] = True
+        print """
+  %s already runs tag:%s (%s). Skipping deploy, use --force to deploy anyway.""" % (app, tag, state['build_hash'])
+    steps.append(Step('check_build', check_build, [step.name for step in steps if step.name != 'metadata'], journaled=False,
+                      description="skip the deploy if %s already runs the build" % app))
+
+    def remove_units():
+      if not state['skip']:
+        with self.metrics.phase('remove_units'):
+          self.remove_units(app)
+    steps.append(Step('remove_units', remove_units, ['check_build'], description="remove all units of %s" % app))
+
+    def env_set():
+      if state['skip']:
+        return
+      # Metadata this deploy couldn't resolve must not keep describing the previous one
+      stale = dict((key, '') for key in DEPLOY_METADATA_KEYS if key not in BUILD_KEYS and key not in state['metadata'])
+      # Build hash and image are stamped once the deploy succeeds, so a failed deploy is never reused
+      if state['build_hash']:
+        stale['BLUEGREEN_BUILD_HASH'] = ''
+      if promote:
+        stale['BLUEGREEN_IMAGE'] = ''
+      with self.metrics.phase('env_set'):
+        self.env_set_many(app, dict(state['metadata'], **stale))
+    steps.append(Step('env_set', env_set, ['check_build'], 1, description="stamp deploy metadata on %s" % app))
+
+    def before_pre():
+      if not state['skip'] and not self.run_hook('before_pre', state['metadata']):
         print """
   Error running 'before_pre' hook. Pre deploy aborted.
         """
-        return 2
-
-    deploy_arguments = ['git', 'push', '--force', app, "%s:master" % tag]
+        return False
+    steps.append(Step('before_pre', before_pre, ['check_build'], description="run 'before_pre' hook"))
 
-    if app_deploy:
-      deploy_arguments = ['tsuru', 'app-deploy', '-a', app] + self.deploy_dir.split()
+    def deploy():
+      if state['skip']:
+        state['status'] = 0
+        return 0
 
-    process = subprocess.Popen(deploy_arguments, stdout=subprocess.PIPE)
-    for line in iter(process.stdout.readline, ''):
-      sys.stdout.write(line)
+      image = self.find_image(tag, state['build_hash'], state['states']) if promote else None
+      if image:
+        print """
+  Promoting image %s of tag:%s to %s ...""" % (image, tag, app)
+        with self.metrics.phase('promote'):
+          state['status'] = self.run_deploy(['tsuru', 'app-deploy', '-a', app, '-i', image], app, tag)
+        if state['status'] != 0:
+          print """
+  Error promoting image %s to %s. Building tag:%s instead ...""" % (image, app, tag)
 
-    process.communicate()
+      if state['status'] != 0:
+        deploy_arguments = ['git', 'push', '--force', app, "%s:master" % tag]
 
-    deploy_status = process.returncode
+        if app_deploy:
+          deploy_arguments = ['tsuru', 'app-deploy', '-a', app] + self.deploy_dir.split()
 
-    if not self.run_hook('after_pre', {"TAG": tag}):
+        with self.metrics.phase('deploy'):
+          state['status'] = self.run_deploy(deploy_arguments, app, tag)
+      # A deploy starts units on the app, whatever it answered
+      self.invalidate(app)
+      if state['status'] != 0:
+        return False
+      return state['status']
+    # Optional, so after_pre still runs after a failed deploy; failing keeps it out of the journal
+    steps.append(Step('deploy', deploy, ['remove_units', 'env_set', 'before_pre'], required=False,
+                      restore=lambda status: state.update(status=status),
+                      description="%s %s to %s" % ("promote or build" if promote else "build", tag, app)))
+
+    def stamp_build():
+      built = {}
+      if state['status'] == 0 and not state['skip'] and state['build_hash']:
+        built['BLUEGREEN_BUILD_HASH'] = state['build_hash']
+      if state['status'] == 0 and not state['skip'] and promote:
+        built['BLUEGREEN_IMAGE'] = self.latest_image(app) or ''
+      if built:
+        self.env_set_many(app, built)
+    steps.append(Step('stamp_build', stamp_build, ['deploy'], 2 if promote else 1,
+                      description="stamp the build hash%s on %s" % (" and image" if promote else "", app)))
+    after_pre_depends = ['stamp_build']
+
+    if self.prewarm and live:
+      def prewarm():
+        if state['status'] != 0:
+          return
+        with self.metrics.phase('prewarm'):
+          if not self.prewarm_units(app, live):
+            print """
+  Error pre-warming %s. Pre deploy aborted.
+            """ % app
+            return False
+      steps.append(Step('prewarm', prewarm, ['deploy'], description="scale %s to the units of %s" % (app, live)))
+      after_pre_depends.append('prewarm')
+
+    def after_pre():
+      if not self.run_hook('after_pre', state['metadata']):
         print """
   Error running 'after_pre' hook. Pre deploy aborted.
         """
-        return 2
+        return False
+    steps.append(Step('after_pre', after_pre, after_pre_depends, description="run 'after_pre' hook"))
 
-    return deploy_status
+    plan = Plan("Plan to deploy tag:%s to %s" % (tag, app), steps)
+    plan.state = state
+    plan.journal = {'action': 'pre', 'key': {'app': app, 'tag': tag}}
+    # --force deploys again from scratch, whatever an earlier run completed
+    if not force:
+      self.resume(plan)
+    return plan
 
-  def deploy_swap(self, apps, cname):
+  def deploy_pre(self, app, tag, app_deploy, live=None, force=False, dry_run=False):
     print """
-  Changing live application to %s ...""" % apps[1]
-
-    tag = self.env_get(apps[1], 'TAG')
+  Pre deploying tag:%s to %s ...
+    """ % (tag, app)
 
-    if not self.run_hook('before_swap', {"TAG": tag}):
+    plan = self.plan_pre(app, tag, app_deploy, live, force)
+    if dry_run:
+      print "\n" + plan.describe()
+      return 0
+
+    self.execute(plan)
+    return 2 if plan.failed else plan.state['status']
+
+  def plan_swap(self, apps, cname):
+    """Read the state of both apps once and plan the steps making apps[1] live.
+
+    An unfinished swap of the same apps is resumed instead: its apps, which
+    discover gives back reversed once the cnames were swapped, and the state it
+    read are taken from the journal.
+    """
+    key = {'apps': sorted(apps)}
+    journal = self.unfinished_journal('swap', key)
+    if journal:
+      apps, cname = journal['apps'], journal['cname']
+      context = journal['context']
+    else:
+      with self.metrics.phase('read_state'):
+        context = dict(zip(['metadata', 'live_units', 'pre_units'],
+                           run_concurrently([lambda: self.env_get_many(apps[1], DEPLOY_METADATA_KEYS),
+                                             lambda: self.total_units(apps[0]),
+                                             lambda: self.total_units(apps[1])], 3)))
+    live, pre = apps
+    metadata, live_units, pre_units = context['metadata'], context['live_units'], context['pre_units']
+
+    tag = metadata['TAG']
+    hook_env = dict((key, value) for key, value in metadata.iteritems() if value is not None)
+    rolling = self.rolling_swap['enabled']
+    steps = []
+
+    def before_swap():
+      if not self.run_hook('before_swap', hook_env):
         print """
   Error running 'before_swap' hook. Pre deploy aborted.
         """
-        return 2
+        return False
+    steps.append(Step('before_swap', before_swap, description="run 'before_swap' hook"))
+
+    scaling = []
+    if rolling:
+      threshold = self.rolling_swap['threshold']
+      swap_units = dict((process_name, min(units, max(1, int(math.ceil(threshold * units)))))
+                        for process_name, units in live_units.iteritems())
+
+      def roll():
+        if not self.roll_units(pre, live, live_units, swap_units, 1):
+          print "\n  Error rolling units of {} into {}. Aborting...".format(live, pre)
+          return False
+      steps.append(Step('roll', roll, ['before_swap'], self.roll_calls(pre_units, swap_units), phase='add_units',
+                        description="roll units of %s into %s until it has %s" % (live, pre, json.dumps(swap_units, sort_keys=True))))
+      scaling.append('roll')
+    else:
+      for process_name, units in sorted(live_units.iteritems()):
+        units_to_add = units - pre_units.get(process_name, 0)
+        if units_to_add <= 0:
+          continue
+        operation = lambda units_to_add=units_to_add, units=units, process_name=process_name: \
+                      self.add_units_per_process_type(pre, units_to_add, units, process_name)
+        if self.max_workers > 1:
+          operation = self.lock_aware(operation)
+        operation = self.bounded(operation)
+        steps.append(Step('add_units:' + process_name, operation, ['before_swap'], 2, phase='add_units',
+                          description="add %d '%s' units to %s" % (units_to_add, process_name, pre)))
+        scaling.append('add_units:' + process_name)
+
+    swap_depends = scaling or ['before_swap']
+    if self.readiness_timeout:
+      def readiness():
+        if self.wait_units_ready(pre, self.readiness_timeout) is None:
+          print "\n  Units of {} are not ready. Aborting...".format(pre)
+          return False
+      steps.append(Step('readiness', readiness, swap_depends, 1, phase='readiness',
+                        description="wait up to %ds for %s units to start" % (self.readiness_timeout, pre)))
+      swap_depends = ['readiness']
+
+    def swap():
+      if not self.swap(live, pre, False):
+        print "\n  Error swaping {} and {}. Aborting...".format(live, pre)
+        # The roll shrank live, which still has the cname: grow it back before scaling pre down
+        if rolling and not self.roll_units(live, pre, live_units, live_units, 1):
+          print "\n  Error rolling units of {} back into {}.".format(pre, live)
+        self.remove_units(pre, 1)
+        return False
+      print "\n  Apps {} and {} cnames successfullly swapped!".format(live, pre)
+    # Scaling pre back down on failure undoes the scaling steps, so they must not be skipped on a rerun
+    steps.append(Step('swap', swap, swap_depends, 1, phase='swap', rolls_back=True,
+                      description="swap cnames of %s and %s" % (live, pre)))
+
+    notifications = []
+    notifiers = [name for name, _, _ in self.notifiers(pre, tag)]
+    steps.append(Step('notify', lambda: notifications.extend(self.start_notifications(pre, tag)), ['swap'], required=False,
+                      description="start notifications (%s)" % (", ".join(notifiers) or "none configured")))
+
+    remove_depends = ['swap']
+    if rolling:
+      def roll_rest():
+        if not self.roll_units(pre, live, live_units, live_units, 0):
+          print "\n  Error rolling the remaining units of {} into {}. Keeping the units of {}.".format(live, pre, live)
+          return False
+      steps.append(Step('roll_rest', roll_rest, ['swap'], self.roll_calls(swap_units, live_units), phase='roll_units',
+                        description="roll the remaining units of %s into %s" % (live, pre)))
+      remove_depends = ['roll_rest']
+
+    if self.drain_in_background:
+      steps.append(Step('remove_units', lambda: self.start_drain(live), remove_depends, required=False,
+                        phase='remove_units', description="remove all units of %s in background" % live))
+    else:
+      steps.append(Step('remove_units', lambda: self.remove_units(live), remove_depends, 1 + len(live_units),
+                        required=False, phase='remove_units',
+                        description="remove all units of %s (%s)" % (live, json.dumps(live_units, sort_keys=True))))
+
+    def after_swap():
+      if not self.run_hook('after_swap', hook_env):
+        print """
+Error running 'after_swap' hook.
+        """
+        return False
+    steps.append(Step('after_swap', after_swap, ['remove_units'], description="run 'after_swap' hook"))
+
+    steps.append(Step('join_notifications', lambda: self.join_notifications(notifications), ['notify'],
+                      required=False, phase='notifications', description="wait for notifications"))
+
+    plan = Plan("Plan to make %s live instead of %s" % (pre, live), steps)
+    plan.journal = {'action': 'swap', 'key': key, 'apps': list(apps), 'cname': cname, 'context': context}
+    if journal:
+      self.resume(plan, journal)
+    return plan
+
+  def bounded(self, operation):
+    """Wrap a scaling step so at most max_workers of them run at a time."""
+    def run():
+      with self.scale_slots:
+        return operation()
+    return run
+
+  def journal_path(self):
+    return os.path.join(self.state_dir, 'journal-%s.json' % self.app_name)
+
+  def unfinished_journal(self, action, key):
+    """The journal of an earlier run of the same action that completed some steps but did not finish, if any."""
+    journal = encode_strings(read_state(self.journal_path()))
+    if (journal and journal['state'] in ('running', 'failed') and journal['completed'] and
+        journal['action'] == action and journal['key'] == key):
+      return journal
+    return None
+
+  def resume(self, plan, journal=None):
+    """Mark the steps an unfinished run of plan completed as done, restoring their results."""
+    journal = journal or self.unfinished_journal(plan.journal['action'], plan.journal['key'])
+    if not journal:
+      return
+    completed = journal['completed']
+    for step in plan.steps:
+      if step.journaled and step.name in completed:
+        step.status = 'done'
+        step.result = completed[step.name]
+        if step.restore:
+          step.restore(step.result)
+    plan.journal['started_at'] = journal['started_at']
+    plan.journal['completed'] = completed
+    started_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(journal['started_at']))
+    print """
+  Resuming the %s started at %s, skipping: %s""" % (journal['action'], started_at,
+                                            ", ".join(step.name for step in plan.steps if step.status == 'done'))
+
+  def write_journal(self, plan, state):
+    journal = dict(plan.journal, state=state)
+    journal.setdefault('started_at', time.time())
+    journal.setdefault('completed', {})
+    plan.journal = journal
+    write_state(self.journal_path(), journal)
+
+  def execute(self, plan):
+    """Run the steps of a plan, recording their phases and reporting the critical path.
+
+    Plans with a journal record each step as it completes, so an interrupted
+    run can be resumed from there.
+    """
+    journal = plan.journal
+    rolled_back = []
+
+    def on_finish(step):
+      if step.rolls_back and step.status == 'failed':
+        rolled_back.append(step)
+        self.write_journal(plan, 'rolled_back')
+      elif step.journaled and step.status == 'done':
+        result = step.result if isinstance(step.result, (int, long, float, basestring)) else None
+        plan.journal['completed'][step.name] = result
+        self.write_journal(plan, 'rolled_back' if rolled_back else 'running')
+
+    started = time.time()
+    state = 'failed'
+    try:
+      if journal is not None:
+        self.write_journal(plan, 'running')
+      run_graph(plan.steps, STEP_WORKERS, on_finish if journal is not None else None)
+      state = 'failed' if plan.failed else 'done'
+    finally:
+      if journal is not None:
+        self.write_journal(plan, 'rolled_back' if rolled_back else state)
+      self.metrics.record_steps(plan.steps)
+      seconds, path = critical_path(plan.steps)
+      self.metrics.stats['critical_path'] = {'seconds': seconds, 'steps': [step.name for step in path]}
+      print "\n  Critical path: %.1fs of %.1fs (%s)" % (seconds, time.time() - started,
+                                                      " > ".join("%s %.1fs" % (step.name, step.elapsed) for step in path))
+
+  def roll_calls(self, start_units, goal_units):
+    """Estimate the tsuru API calls of rolling from start_units to goal_units."""
+    max_surplus = max(1, self.rolling_swap['max_surplus'])
+    rounds = [int(math.ceil(float(max(0, units - start_units.get(process_name, 0))) / max_surplus))
+              for process_name, units in goal_units.iteritems()]
+    # per round: 2 snapshots and 1 readiness poll; per process type and round: 1 removal, 1 addition and its check
+    return 3 * max(rounds or [0]) + 3 * sum(rounds)
+
+  def deploy_swap(self, apps, cname, dry_run=False):
+    plan = self.plan_swap(apps, cname)
+    print """
+  Changing live application to %s ...""" % plan.journal['apps'][1]
+    if dry_run:
+      print "\n" + plan.describe()
+      return 0
 
-    if not self.add_units(apps[1], self.total_units(apps[0])):
-      return 2
+    self.execute(plan)
+    return 2 if plan.failed else 0
 
-    if not self.swap(apps[0], apps[1], False):
-      print "\n  Error swaping {} and {}. Aborting...".format(apps[0], apps[1])
-      self.remove_units(apps[1], 1)
-      return 2
 
-    print "\n  Apps {} and {} cnames successfullly swapped!".format(apps[0], apps[1])
+class Fleet:
+  """Runs one action over many blue/green app pairs, a few of them at a time."""
+  def __init__(self, token, target, configs, concurrency=4, dry_run=False, force=False):
+    self.token = token
+    self.target = target
+    self.configs = configs
+    self.concurrency = concurrency
+    self.dry_run = dry_run
+    self.force = force
+    # Every app of the fleet talks to the same tsuru API, so they share its limits
+    self.limiter = None
+    if configs and 'rate_limit' in configs[0]:
+      rate_limit = configs[0]['rate_limit']
+      self.limiter = RateLimiter(rate_limit['rate'], rate_limit['burst'], rate_limit['concurrency'])
+
+  def run_app(self, config, action, tag):
+    started = time.time()
+    result = {'name': config['name'], 'status': None, 'error': None}
+    try:
+      bluegreen = BlueGreen(self.token, self.target, config, self.limiter)
+      if action == 'drain-status':
+        bluegreen.print_drain_status()
+        result['status'] = 0
+        result['elapsed'] = time.time() - started
+        return result
+
+      try:
+        apps, cname = bluegreen.discover()
+        if action == 'pre':
+          result['status'] = bluegreen.deploy_pre(apps[1], tag, config['deploy_dir'] != None, apps[0], self.force, self.dry_run)
+        elif action == 'swap':
+          result['status'] = bluegreen.deploy_swap(apps, cname, self.dry_run)
+        elif action == 'cname':
+          print "  %s: %s" % (config['name'], bluegreen.get_cname(apps[0]))
+          result['status'] = 0
+      finally:
+        # A run that raised is the one most worth recording
+        bluegreen.export_metrics()
+    except Exception as e:
+      result['status'] = 2
+      result['error'] = e
+    result['elapsed'] = time.time() - started
+    return result
+
+  def run(self, action, tag):
+    started = time.time()
+    results = run_concurrently([lambda config=config: self.run_app(config, action, tag) for config in self.configs],
+                               self.concurrency)
+    self.print_summary(results, time.time() - started)
 
-    self.remove_units(apps[0])
+    for result in results:
+      if result['status'] != 0:
+        return 2
+    return 0
 
-    self.notify_newrelic(tag)
+  def print_summary(self, results, elapsed):
+    print """
+  Fleet summary (%d apps in %.1fs):
+""" % (len(results), elapsed)
+    for result in results:
+      if result['error'] is not None:
+        outcome = 'error: %s' % result['error']
+      elif result['status'] == 0:
+        outcome = 'ok'
+      else:
+        outcome = 'failed (%s)' % result['status']
+      print "  %-30s %-40s %8.1fs" % (result['name'], outcome, result['elapsed'])
 
-    self.notify_grafana(apps[1], tag)
+class Daemon:
+  """Serves pre, swap and status requests for a set of apps over a local HTTP/JSON API.
 
-    self.run_webhook(tag)
+  Each app keeps one BlueGreen instance, with its connection pool, and one
+  worker thread running its jobs in order. Deploys of an app never overlap,
+  while different apps deploy in parallel.
+  """
+  def __init__(self, token, target, configs):
+    self.token = token
+    self.target = target
+    self.configs = dict((config['name'], config) for config in configs)
+    self.limiter = None
+    if configs and 'rate_limit' in configs[0]:
+      rate_limit = configs[0]['rate_limit']
+      self.limiter = RateLimiter(rate_limit['rate'], rate_limit['burst'], rate_limit['concurrency'])
+    self.lock = threading.Lock()
+    self.apps = {}
+    self.jobs = {}
+    self.finished = {}
+    self.last_job_id = 0
+    self.server = None
+
+  def app(self, name):
+    """The BlueGreen instances, job queue and jobs of an app, starting its worker on first use.
+
+    Status requests read the apps with their own instance, so they never touch
+    the cache or metrics of a running job."""
+    import Queue
+    with self.lock:
+      if name not in self.apps:
+        app = {'bluegreen': BlueGreen(self.token, self.target, self.configs[name], self.limiter),
+               'reader': BlueGreen(self.token, self.target, self.configs[name], self.limiter),
+               'queue': Queue.Queue(), 'jobs': []}
+        worker = threading.Thread(target=self.work, args=(app,))
+        worker.daemon = True
+        worker.start()
+        self.apps[name] = app
+      return self.apps[name]
+
+  def submit(self, name, action, tag=None, force=False):
+    app = self.app(name)
+    with self.lock:
+      self.last_job_id += 1
+      job = {'id': self.last_job_id, 'app': name, 'action': action, 'tag': tag, 'force': force,
+             'state': 'queued', 'status': None, 'error': None,
+             'queued_at': time.time(), 'started_at': None, 'elapsed': None}
+      self.jobs[job['id']] = job
+      self.finished[job['id']] = threading.Event()
+      app['jobs'].append(job)
+      snapshot = dict(job, position=app['queue'].qsize() + 1)
+    app['queue'].put(job)
+    return snapshot
+
+  def job(self, job_id):
+    with self.lock:
+      job = self.jobs.get(job_id)
+      return dict(job) if job else None
+
+  def wait(self, job_id, timeout=None):
+    """Wait for a job to finish and return it."""
+    with self.lock:
+      finished = self.finished.get(job_id)
+    if finished:
+      finished.wait(timeout)
+    return self.job(job_id)
+
+  def work(self, app):
+    while True:
+      job = app['queue'].get()
+      self.run_job(app, job)
+      with self.lock:
+        self.finished[job['id']].set()
+        done = [job for job in app['jobs'] if job['state'] in ('done', 'failed')]
+        for job in done[:-DAEMON_JOB_HISTORY]:
+          app['jobs'].remove(job)
+          del self.jobs[job['id']]
+          del self.finished[job['id']]
+
+  def run_job(self, app, job):
+    bluegreen = app['bluegreen']
+    started = time.time()
+    with self.lock:
+      job.update(state='running', started_at=started)
+
+    status, error = 2, None
+    try:
+      # Builds, other tsuru clients and status requests change the apps between jobs
+      bluegreen.clear_cache()
+      bluegreen.metrics = Metrics(bluegreen.app_name)
+      bluegreen.lock_conflict.clear()
 
-    if not self.run_hook('after_swap', {"TAG": tag}):
-      print """
-Error running 'after_swap' hook.
-        """
-      return 2
+      try:
+        apps, cname = bluegreen.discover()
+        if job['action'] == 'pre':
+          status = bluegreen.deploy_pre(apps[1], job['tag'], bluegreen.deploy_dir != None, apps[0], job['force'])
+        elif job['action'] == 'swap':
+          status = bluegreen.deploy_swap(apps, cname)
+      finally:
+        bluegreen.export_metrics()
+    except Exception as e:
+      error = str(e)
+
+    with self.lock:
+      job.update(state='done' if status == 0 else 'failed', status=status, error=error,
+                 elapsed=time.time() - started)
+
+  def status(self, name):
+    """The live and pre apps of name, with its queued, running and last finished jobs."""
+    app = self.app(name)
+    apps, cname = app['reader'].discover(refresh=True)
+    with self.lock:
+      jobs = [dict(job) for job in app['jobs']]
+    return {'app': name, 'live': apps[0], 'pre': apps[1], 'cname': cname, 'jobs': jobs}
+
+  def handle(self, method, path, body):
+    """Answer one API request, as (HTTP status, JSON payload).
+
+      GET  /apps                   names of the apps served
+      GET  /apps/<name>            status of an app and its jobs
+      POST /apps/<name>/pre        queue a pre deploy, body {"tag": "1.2.0", "force": false}
+      POST /apps/<name>/swap       queue a swap
+      GET  /jobs/<id>              one job
+
+    POST requests answer 202 with the queued job, or wait for it to finish with ?wait=1.
+    """
+    from urlparse import parse_qs
+    url = urlparse(path)
+    if url.path == '/apps' and method == 'GET':
+      return 200, {'apps': sorted(self.configs)}
+
+    match = re.match(r'^/jobs/(\d+)$', url.path)
+    if match and method == 'GET':
+      job = self.job(int(match.group(1)))
+      return (200, job) if job else (404, {'error': 'unknown job %s' % match.group(1)})
+
+    match = re.match(r'^/apps/([^/]+)(?:/(pre|swap))?$', url.path)
+    if not match:
+      return 404, {'error': 'unknown path %s' % url.path}
+    name, action = match.groups()
+    if name not in self.configs:
+      return 404, {'error': 'unknown app %s' % name}
+    if action is None and method == 'GET':
+      return 200, self.status(name)
+    if action is None or method != 'POST':
+      return 405, {'error': '%s not allowed on %s' % (method, url.path)}
 
-    return 0
+    try:
+      options = json.loads(body or '{}')
+    except ValueError:
+      return 400, {'error': 'body is not JSON'}
+    if not isinstance(options, dict):
+      return 400, {'error': 'body is not a JSON object'}
+
+    job = self.submit(name, action, str(options.get('tag') or 'master') if action == 'pre' else None,
+                      bool(options.get('force')))
+    if parse_qs(url.query).get('wait', ['0'])[0] not in ('0', ''):
+      return 200, self.wait(job['id'])
+    return 202, job
+
+  def start(self, listen=DAEMON_LISTEN):
+    """Listen on host:port and serve requests from a background thread."""
+    import BaseHTTPServer
+    import SocketServer
+    daemon = self
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self, format, *args):
+        pass
 
+      def do_GET(self):
+        self.respond('GET')
+
+      def do_POST(self):
+        self.respond('POST')
+
+      def respond(self, method):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        try:
+          status, payload = daemon.handle(method, self.path, body)
+        except Exception as e:
+          status, payload = 500, {'error': str(e)}
+
+        data = json.dumps(payload, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+      daemon_threads = True
+      allow_reuse_address = True
+
+    host, port = listen.rsplit(':', 1)
+    self.server = Server((host, int(port)), Handler)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  @property
+  def address(self):
+    return '%s:%d' % self.server.server_address[:2]
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+    for app in self.apps.values():
+      app['bluegreen'].pool.close()
+      app['reader'].pool.close()
 
 class Config:
   @classmethod
-  def load(self, filepath):
+  def cache_path(self, filepath, section):
+    directory = os.environ.get('TSURU_BLUEGREEN_CACHE_DIR')
+    if not directory:
+      cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+      directory = os.path.join(cache_home, 'tsuru-bluegreen')
+    import hashlib
+    key = hashlib.sha1('%s\0%s' % (os.path.abspath(filepath), section)).hexdigest()
+    return os.path.join(directory, 'config-%s.json' % key)
+
+  @classmethod
+  def load_cached(self, filepath, section='Application'):
+    """Same as load, reusing the parsed config while the .ini file (and the
+    NEW_RELIC_* variables it may fall back to) are unchanged.
+
+    The cache keeps only a hash of those variables, and New Relic values
+    taken from them are read from the environment again on each call."""
+    import hashlib
+    try:
+      stat = os.stat(filepath)
+    except OSError:
+      return self.load(filepath, section)
+
+    path = self.cache_path(filepath, section)
+    env = hashlib.sha1(json.dumps([os.environ.get(name) for name in CONFIG_CACHE_ENV])).hexdigest()
+    cached = read_state(path)
+    if cached and cached.get('mtime') == stat.st_mtime and cached.get('size') == stat.st_size and cached.get('env') == env:
+      config = encode_strings(cached['config'])
+      for key in cached.get('newrelic_from_env', []):
+        config['newrelic'][key] = os.getenv('NEW_RELIC_' + key.upper())
+      return config
+
+    config = self.load(filepath, section)
+    newrelic = dict(config['newrelic'])
+    from_env = [key for key, value in newrelic.items()
+                if value is not None and value == os.getenv('NEW_RELIC_' + key.upper())]
+    for key in from_env:
+      newrelic[key] = None
+    try:
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0700)
+      # An api_key written in the .ini itself still lands in the cache
+      write_state(path, {'mtime': stat.st_mtime, 'size': stat.st_size, 'env': env, 'newrelic_from_env': from_env,
+                         'config': dict(config, newrelic=newrelic)}, 0600)
+    except (IOError, OSError):
+      pass
+    return config
+
+  @classmethod
+  def load_fleet(self, path):
+    """Load every app of a fleet: each .ini file of a directory, or each
+    [Application:<name>] section of a single file."""
+    import ConfigParser
+    if os.path.isdir(path):
+      configs = []
+      for filename in sorted(os.listdir(path)):
+        if filename.endswith('.ini'):
+          configs.extend(self.load_fleet(os.path.join(path, filename)))
+      return configs
+
+    config = ConfigParser.ConfigParser()
+    config.read(path)
+    if config.has_section('Application'):
+      return [self.load(path)]
+    return [self.load(path, section) for section in config.sections() if section.startswith('Application:')]
+
+  @classmethod
+  def load(self, filepath, section='Application'):
+    import ConfigParser
     config = ConfigParser.ConfigParser()
     config.read(filepath)
 
-    app_name = config.get('Application', 'name')
+    try:
+      app_name = config.get(section, 'name')
+    except ConfigParser.NoOptionError:
+      if ':' not in section:
+        raise
+      app_name = section.split(':', 1)[1].strip()
 
     try:
-      deploy_dir = config.get('Application', 'deploy_dir')
+      deploy_dir = config.get(section, 'deploy_dir')
     except ConfigParser.NoOptionError:
       deploy_dir = None
 
+    try:
+      prewarm = config.getboolean(section, 'prewarm')
+    except (ConfigParser.NoOptionError, ValueError):
+      prewarm = False
+
+    try:
+      deploy_strategy = config.get(section, 'deploy_strategy')
+      if deploy_strategy not in ('build', 'promote'):
+        deploy_strategy = 'build'
+    except ConfigParser.NoOptionError:
+      deploy_strategy = 'build'
+
     try:
       retry_times = config.getint('UnitsRemoval', 'retry_times')
     except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
@@ -385,6 +2479,53 @@ class Config:
     except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
       retry_sleep = 0
 
+    try:
+      retry_max_sleep = config.getint('UnitsRemoval', 'retry_max_sleep')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      retry_max_sleep = 60
+
+    try:
+      retry_deadline = config.getint('UnitsRemoval', 'retry_deadline')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      retry_deadline = 0
+
+    try:
+      drain_in_background = config.getboolean('UnitsRemoval', 'background')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      drain_in_background = False
+
+    try:
+      max_workers = config.getint('Scaling', 'max_workers')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      max_workers = 1
+
+    try:
+      readiness_timeout = config.getint('Readiness', 'timeout')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      readiness_timeout = 0
+
+    #RollingSwap
+    rolling_swap = {
+      'enabled': False,
+      'max_surplus': 1,
+      'threshold': 1.0
+    }
+
+    try:
+      rolling_swap['enabled'] = config.getboolean('RollingSwap', 'enabled')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      pass
+
+    try:
+      rolling_swap['max_surplus'] = max(1, config.getint('RollingSwap', 'max_surplus'))
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      pass
+
+    try:
+      rolling_swap['threshold'] = min(1.0, max(0.0, config.getfloat('RollingSwap', 'threshold')))
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      pass
+
     hooks = {
       'before_pre': None,
       'after_pre': None,
@@ -400,6 +2541,11 @@ class Config:
       except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
         pass
 
+    try:
+      hook_timeout = config.getint('Hooks', 'timeout')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      hook_timeout = 0
+
     #NewRelic
     newrelic = {
       'api_key': None,
@@ -447,22 +2593,107 @@ class Config:
       except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
         pass
 
+    #Notifications
+    notifications = {
+      'timeout': 10,
+      'join_timeout': 10
+    }
+
+    for key in notifications:
+      try:
+        notifications[key] = config.getint('Notifications', key)
+
+      except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+        pass
+
+    #DeployLog
+    deploy_log = {
+      'directory': None,
+      'tail_lines': 100
+    }
+
+    try:
+      deploy_log['directory'] = config.get('DeployLog', 'directory') or None
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+      pass
+
+    try:
+      deploy_log['tail_lines'] = max(1, config.getint('DeployLog', 'tail_lines'))
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      pass
+
+    #RateLimit
+    rate_limit = {
+      'rate': 0,
+      'burst': 0,
+      'concurrency': 0,
+      'max_retries': 3,
+      'max_wait': 60
+    }
+
+    try:
+      rate_limit['rate'] = config.getfloat('RateLimit', 'rate')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+      pass
+
+    for key in ['burst', 'concurrency', 'max_retries', 'max_wait']:
+      try:
+        rate_limit[key] = config.getint('RateLimit', key)
+      except (ConfigParser.NoSectionError, ConfigParser.NoOptionError, ValueError):
+        pass
+
+    #Metrics
+    metrics = {
+      'json_report': None,
+      'prometheus_textfile': None
+    }
+
+    for key in metrics:
+      try:
+        metrics_value = config.get('Metrics', key)
+        if metrics_value:
+          metrics[key] = metrics_value
+
+      except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        pass
+
     return {'name' : app_name,
             'deploy_dir' : deploy_dir,
+            'prewarm' : prewarm,
+            'deploy_strategy' : deploy_strategy,
             'retry_times' : retry_times,
             'retry_sleep' : retry_sleep,
+            'retry_max_sleep' : retry_max_sleep,
+            'retry_deadline' : retry_deadline,
+            'drain_in_background' : drain_in_background,
+            'max_workers' : max_workers,
+            'readiness_timeout' : readiness_timeout,
+            'rolling_swap' : rolling_swap,
             'hooks' : hooks,
+            'hook_timeout' : hook_timeout,
             'newrelic' : newrelic,
             'grafana' : grafana,
-            'webhook' : webhook}
+            'webhook' : webhook,
+            'notifications' : notifications,
+            'deploy_log' : deploy_log,
+            'rate_limit' : rate_limit,
+            'metrics' : metrics}
 
 if __name__ == "__main__":
+  import argparse
+
   #Parameters
   parser = argparse.ArgumentParser(description='Tsuru blue-green deployment (pre and live).',
                                   usage='tsuru bluegreen action [options]')
 
-  parser.add_argument('action', metavar='action', help='pre or swap', choices=['pre', 'swap', 'cname'])
+  parser.add_argument('action', metavar='action', help='pre, swap, cname, drain-status or daemon', choices=['pre', 'swap', 'cname', 'drain', 'drain-status', 'daemon'])
   parser.add_argument('-t', '--tag', metavar='TAG', help='Tag to be deployed (default: master)', nargs='?', default="master")
+  parser.add_argument('--fleet', metavar='PATH', help='Run the action for every app in a directory of .ini files or in the [Application:<name>] sections of a file')
+  parser.add_argument('--concurrency', metavar='N', type=int, help='How many fleet apps to deploy at the same time (default: 4)', default=4)
+  parser.add_argument('--dry-run', action='store_true', help='Print the planned pre or swap steps and their estimated tsuru API calls without running them')
+  parser.add_argument('--force', action='store_true', help='Deploy on pre even if it already runs the same tag and build')
+  parser.add_argument('--listen', metavar='HOST:PORT', help='Address the daemon serves its HTTP API on (default: %s)' % DAEMON_LISTEN, default=DAEMON_LISTEN)
+  parser.add_argument('--app', help=argparse.SUPPRESS)
 
   args = parser.parse_args()
 
@@ -470,30 +2701,50 @@ if __name__ == "__main__":
   token = os.environ['TSURU_TOKEN']
   target = os.environ['TSURU_TARGET']
 
-  config = Config.load('tsuru-bluegreen.ini')
+  if args.action == 'drain':
+    state = read_state(os.path.join(STATE_DIR, 'drain-%s.json' % args.app))
+    bluegreen = BlueGreen(token, target, state['config'])
+    sys.exit(0 if bluegreen.drain(args.app) else 2)
 
-  app_name = config['name']
-  blue = "%s-blue" % app_name
-  green = "%s-green" % app_name
+  if args.action == 'daemon':
+    configs = Config.load_fleet(args.fleet) if args.fleet else [Config.load_cached('tsuru-bluegreen.ini')]
+    daemon = Daemon(token, target, configs).start(args.listen)
+    print "  Serving %s on http://%s" % (", ".join(sorted(daemon.configs)), daemon.address)
+    try:
+      while True:
+        time.sleep(3600)
+    except KeyboardInterrupt:
+      daemon.stop()
+    sys.exit(0)
 
-  bluegreen = BlueGreen(token, target, config)
+  if args.fleet:
+    fleet = Fleet(token, target, Config.load_fleet(args.fleet), args.concurrency, args.dry_run, args.force)
+    sys.exit(fleet.run(args.action, args.tag))
 
-  apps = [blue, green]
-  cnames = [bluegreen.get_cname(green), bluegreen.get_cname(blue)]
+  config = Config.load_cached('tsuru-bluegreen.ini')
 
-  #reverse if first is not None
-  if cnames[0] is not None:
-    cnames.reverse()
-    apps.reverse()
+  bluegreen = BlueGreen(token, target, config)
+
+  if args.action == 'drain-status':
+    bluegreen.print_drain_status()
+    sys.exit(0)
 
-  cname = cnames[1]
+  apps, cname = bluegreen.discover()
   pre = apps[1]
 
   app_deploy = config['deploy_dir'] != None
 
   if args.action == 'pre':
-    sys.exit(bluegreen.deploy_pre(pre, args.tag, app_deploy))
+    try:
+      status = bluegreen.deploy_pre(pre, args.tag, app_deploy, apps[0], args.force, args.dry_run)
+    finally:
+      bluegreen.export_metrics()
+    sys.exit(status)
   elif args.action == 'cname':
     print bluegreen.get_cname(apps[0])
   elif args.action == 'swap':
-    sys.exit(bluegreen.deploy_swap(apps, cname))
+    try:
+      status = bluegreen.deploy_swap(apps, cname, args.dry_run)
+    finally:
+      bluegreen.export_metrics()
+    sys.exit(status)
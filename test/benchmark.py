@@ -0,0 +1,139 @@
+"""End-to-end benchmark of the pre and swap flows against a fake tsuru API.
+
+  python test/benchmark.py --latency 20 --units web=4,worker=2 --lock-conflicts 2
+
+Prints, for each flow, its wall time, how many API requests it made and the
+latency percentiles of those requests.
+"""
+import argparse
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bluegreen import BlueGreen
+from fake_tsuru import FakeTsuru
+
+
+def percentile(values, fraction):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def parse_units(value):
+  units = {}
+  for item in value.split(','):
+    process_name, count = item.split('=')
+    units[process_name] = int(count)
+  return units
+
+
+def fake_tsuru_client():
+  """A `tsuru` executable that accepts app-deploy without deploying anything."""
+  directory = tempfile.mkdtemp()
+  path = os.path.join(directory, 'tsuru')
+  with open(path, 'w') as script:
+    script.write('#!/bin/sh\necho "deploying $@"\n')
+  os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+  return directory
+
+
+def config_for(name, options):
+  return {
+    'name': name,
+    'deploy_dir': '.',
+    'retry_times': 20,
+    'retry_sleep': 0,
+    'max_workers': options.max_workers,
+    'readiness_timeout': options.readiness_timeout,
+    'hooks': {},
+    'newrelic': {},
+    'grafana': {},
+    'webhook': {},
+  }
+
+
+def run_flow(name, options, flow):
+  tsuru = FakeTsuru(options.latency / 1000.0, options.lock_conflicts).start()
+  bluegreen = BlueGreen('token', tsuru.target, config_for('bench', options))
+  bluegreen.state_dir = tempfile.mkdtemp()
+  try:
+    tsuru.add_app('bench-blue', options.units, cname=['bench.example.com'], env={'TAG': 'v1'})
+    tsuru.add_app('bench-green', {}, env={'TAG': 'v2'})
+
+    started = time.time()
+    status = flow(bluegreen)
+    elapsed = time.time() - started
+
+    latencies = [request['elapsed'] for request in bluegreen.metrics.requests]
+    return {
+      'flow': name,
+      'status': status,
+      'elapsed': elapsed,
+      'requests': len(tsuru.requests),
+      'connections': bluegreen.pool.stats['new'],
+      'p50': percentile(latencies, 0.5),
+      'p90': percentile(latencies, 0.9),
+      'p99': percentile(latencies, 0.99),
+    }
+  finally:
+    bluegreen.pool.close()
+    tsuru.stop()
+    shutil.rmtree(bluegreen.state_dir)
+
+
+def pre_flow(bluegreen):
+  apps, cname = bluegreen.discover()
+  return bluegreen.deploy_pre(apps[1], 'v2', True)
+
+
+def swap_flow(bluegreen):
+  apps, cname = bluegreen.discover()
+  return bluegreen.deploy_swap(apps, cname)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark bluegreen pre and swap flows against a fake tsuru API.')
+  parser.add_argument('--latency', type=float, default=0, help='latency added to every API response, in ms (default: 0)')
+  parser.add_argument('--lock-conflicts', type=int, default=0, help='how many unit removals answer 409 first (default: 0)')
+  parser.add_argument('--units', type=parse_units, default={'web': 4, 'worker': 2}, help='live app units (default: web=4,worker=2)')
+  parser.add_argument('--max-workers', type=int, default=1, help='[Scaling] max_workers (default: 1)')
+  parser.add_argument('--readiness-timeout', type=int, default=0, help='[Readiness] timeout (default: 0)')
+  parser.add_argument('--runs', type=int, default=3, help='runs of each flow (default: 3)')
+  options = parser.parse_args()
+
+  fake_client = fake_tsuru_client()
+  os.environ['PATH'] = fake_client + os.pathsep + os.environ['PATH']
+  stdout = sys.stdout
+  results = []
+  try:
+    for flow_name, flow in [('pre', pre_flow), ('swap', swap_flow)]:
+      for run in range(options.runs):
+        sys.stdout = open(os.devnull, 'w')
+        try:
+          results.append(run_flow(flow_name, options, flow))
+        finally:
+          sys.stdout.close()
+          sys.stdout = stdout
+  finally:
+    shutil.rmtree(fake_client)
+
+  print '%-6s %6s %9s %9s %12s %9s %9s %9s' % ('flow', 'status', 'wall(s)', 'requests', 'connections', 'p50(ms)', 'p90(ms)', 'p99(ms)')
+  for result in results:
+    print '%-6s %6s %9.3f %9d %12d %9.1f %9.1f %9.1f' % (result['flow'], result['status'], result['elapsed'],
+                                                         result['requests'], result['connections'],
+                                                         result['p50'] * 1000, result['p90'] * 1000, result['p99'] * 1000)
+
+  if any(result['status'] != 0 for result in results):
+    sys.exit(2)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,9 +1,20 @@
+import gzip
+import httplib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
+from mock import ANY
 from mock import MagicMock
 from mock import Mock
 from mock import patch
 import httpretty
-from bluegreen import BlueGreen
+from bluegreen import BlueGreen, Fleet, Metrics, RateLimiter, Step, critical_path, parse_event_time, path_template, retry_after, run_graph, write_state
 
 class TestBlueGreen(unittest.TestCase):
 
@@ -19,9 +30,18 @@ class TestBlueGreen(unittest.TestCase):
       'webhook': {'endpoint': 'http://example.com', 'payload_extras': 'key1=value1&key2=value2'}
     }
 
+    # Deploy journals and drain state go to a fresh directory for each test
+    self.state_dir = tempfile.mkdtemp()
+    self.state_dir_patch = patch('bluegreen.STATE_DIR', self.state_dir)
+    self.state_dir_patch.start()
+
     self.bg = BlueGreen('token', 'tsuruhost.com', self.config)
     self.cnames = [u'cname1', u'cname2']
 
+  def tearDown(self):
+    self.state_dir_patch.stop()
+    shutil.rmtree(self.state_dir)
+
   @httpretty.activate
   def test_get_cname_returns_a_list_when_present(self):
     httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
@@ -69,6 +89,67 @@ class TestBlueGreen(unittest.TestCase):
     self.bg = BlueGreen('token', 'https://tsuruhost.com:8443', self.config)
     self.assertEqual(self.bg.get_cname('xpto'), self.cnames)
 
+  def test_requests_reuse_keep_alive_connections(self):
+    conn = Mock()
+    conn.getresponse.return_value.status = 200
+    conn.getresponse.return_value.will_close = False
+    conn.getresponse.return_value.read.return_value = '{"cname":["cname1", "cname2"]}'
+    self.bg.pool.connect = MagicMock(return_value=conn)
+
+    self.assertEqual(self.bg.get_cname('xpto'), self.cnames)
+    self.bg.clear_cache()
+    self.assertEqual(self.bg.get_cname('xpto'), self.cnames)
+    self.assertEqual(self.bg.pool.connect.call_count, 1)
+    self.assertEqual(self.bg.pool.stats['reused'], 1)
+
+  @httpretty.activate
+  def test_requests_dont_reuse_closed_connections(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
+                           body='{"cname":["cname1", "cname2"]}')
+
+    self.bg.get_cname('xpto')
+    self.bg.clear_cache()
+    self.bg.get_cname('xpto')
+    self.assertEqual(self.bg.pool.stats['new'], 2)
+    self.assertEqual(self.bg.pool.stats['reused'], 0)
+
+  def test_requests_reconnect_when_reused_connection_is_stale(self):
+    stale = Mock()
+    stale.request.side_effect = socket.error('broken pipe')
+    fresh = Mock()
+    fresh.getresponse.return_value.status = 200
+    fresh.getresponse.return_value.will_close = True
+    fresh.getresponse.return_value.read.return_value = '{"cname":[]}'
+    self.bg.pool.idle = [stale]
+    self.bg.pool.connect = MagicMock(return_value=fresh)
+
+    self.assertIsNone(self.bg.get_cname('xpto'))
+    self.assertTrue(stale.close.called)
+    self.assertEqual(self.bg.pool.stats['reconnects'], 1)
+
+  def test_requests_dont_replay_a_sent_non_idempotent_request(self):
+    stale = Mock()
+    stale.getresponse.side_effect = httplib.BadStatusLine('')
+    self.bg.pool.idle = [stale]
+    self.bg.pool.connect = MagicMock()
+
+    self.assertRaises(httplib.BadStatusLine, self.bg.pool.request, 'POST', '/swap', 'bind=true')
+    self.assertEqual(stale.request.call_count, 1)
+    self.assertFalse(self.bg.pool.connect.called)
+
+  def test_requests_replay_a_sent_idempotent_request(self):
+    stale = Mock()
+    stale.getresponse.side_effect = httplib.BadStatusLine('')
+    fresh = Mock()
+    fresh.getresponse.return_value.status = 200
+    fresh.getresponse.return_value.will_close = True
+    fresh.getresponse.return_value.read.return_value = '{"cname":[]}'
+    self.bg.pool.idle = [stale]
+    self.bg.pool.connect = MagicMock(return_value=fresh)
+
+    self.assertIsNone(self.bg.get_cname('xpto'))
+    self.assertEqual(self.bg.pool.stats['reconnects'], 1)
+
   @httpretty.activate
   def test_get_cname_returns_none_when_empty(self):
     httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
@@ -76,6 +157,15 @@ class TestBlueGreen(unittest.TestCase):
 
     self.assertIsNone(self.bg.get_cname('xpto'))
 
+  @httpretty.activate
+  def test_discover_returns_live_app_first(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/test-app-blue',
+                           body='{"cname":[]}')
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/test-app-green',
+                           body='{"cname":["cname1", "cname2"]}')
+
+    self.assertEqual(self.bg.discover(), (['test-app-green', 'test-app-blue'], self.cnames))
+
   @httpretty.activate
   def test_remove_cname_return_true_when_can_remove(self):
     httpretty.register_uri(httpretty.DELETE, 'http://tsuruhost.com/apps/xpto/cname',
@@ -173,6 +263,31 @@ class TestBlueGreen(unittest.TestCase):
 
     self.assertIsNone(self.bg.env_get('xpto', 'TAG'))
 
+  @httpretty.activate
+  def test_env_set_many_sends_all_variables_in_one_request(self):
+    httpretty.register_uri(httpretty.POST, 'http://tsuruhost.com/apps/xpto/env',
+                           status=200)
+
+    self.assertTrue(self.bg.env_set_many('xpto', {'TAG': 'release/1.0', 'BLUEGREEN_BUILD_ID': '42&43'}))
+
+    requests = httpretty.HTTPretty.latest_requests
+    self.assertEqual(len(requests), 1)
+    self.assertEqual('noRestart=true&Envs.0.Name=BLUEGREEN_BUILD_ID&Envs.0.Value=42%2643'
+                     '&Envs.1.Name=TAG&Envs.1.Value=release%2F1.0', requests[0].body)
+
+  @httpretty.activate
+  def test_env_get_many_fetches_all_variables_in_one_request(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto/env',
+                           body='[{"name":"TAG","public":true,"value":"1.0"}, {"name":"BLUEGREEN_COMMIT","public":true,"value":"abc"}]')
+
+    self.assertEqual(self.bg.env_get_many('xpto', ['TAG', 'BLUEGREEN_COMMIT', 'BLUEGREEN_BUILD_ID']),
+                     {'TAG': '1.0', 'BLUEGREEN_COMMIT': 'abc', 'BLUEGREEN_BUILD_ID': None})
+    self.assertEqual(self.bg.env_get('xpto', 'BLUEGREEN_BUILD_ID'), None)
+
+    requests = httpretty.HTTPretty.latest_requests
+    self.assertEqual(len(requests), 1)
+    self.assertEqual({"env": ["TAG", "BLUEGREEN_COMMIT", "BLUEGREEN_BUILD_ID"]}, requests[0].querystring)
+
   @httpretty.activate
   def test_total_units_empty_without_units(self):
     httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
@@ -189,6 +304,72 @@ class TestBlueGreen(unittest.TestCase):
 
     self.assertEqual(self.bg.total_units('xpto'), {'web': 2, 'resque': 1})
 
+  @httpretty.activate
+  def test_app_info_is_fetched_once_for_cname_and_units(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
+                           body='{"cname":["cname1", "cname2"], "units":[{"ProcessName": "web"}]}')
+
+    self.assertEqual(self.bg.get_cname('xpto'), self.cnames)
+    self.assertEqual(self.bg.total_units('xpto'), {'web': 1})
+    self.assertEqual(self.bg.total_units('xpto'), {'web': 1})
+    self.assertEqual(len(httpretty.HTTPretty.latest_requests), 1)
+    self.assertEqual(self.bg.cache_stats, {'hits': 2, 'misses': 1})
+
+  def test_prefetch_fetches_apps_concurrently(self):
+    both_requested = threading.Event()
+    requested = []
+    def get(url):
+      requested.append(url)
+      if len(requested) == 2:
+        both_requested.set()
+      both_requested.wait(5)
+      response = Mock()
+      response.status = 200
+      response.read.return_value = '{"cname":[], "units":[]}'
+      return response
+    self.bg.get = Mock(side_effect=get)
+
+    self.bg.prefetch(['test-blue', 'test-green'])
+
+    self.assertTrue(both_requested.is_set())
+    self.assertIsNone(self.bg.get_cname('test-blue'))
+    self.assertEqual(self.bg.total_units('test-green'), {})
+    self.assertEqual(self.bg.get.call_count, 2)
+
+  @httpretty.activate
+  def test_app_info_is_refetched_after_changing_units(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
+                           responses=[
+                             httpretty.Response(body='{"units":[{"ProcessName": "web"}]}'),
+                             httpretty.Response(body='{"units":[{"ProcessName": "web"}, {"ProcessName": "web"}]}')
+                           ])
+    httpretty.register_uri(httpretty.PUT, 'http://tsuruhost.com/apps/xpto/units',
+                           data='',
+                           status=200)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body='',
+                           status=204)
+
+    self.assertTrue(self.bg.add_units('xpto', {'web': 2}))
+    self.assertEqual(self.bg.total_units('xpto'), {'web': 2})
+    requests = [request for request in httpretty.HTTPretty.latest_requests if not request.path.startswith('/events')]
+    self.assertEqual(len(requests), 3)
+
+  @httpretty.activate
+  def test_env_get_is_cached_until_env_set(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto/env',
+                           body='[{"name":"TAG","public":true,"value":"1.0"}]')
+    httpretty.register_uri(httpretty.POST, 'http://tsuruhost.com/apps/xpto/env',
+                           status=200)
+
+    self.assertEqual(self.bg.env_get('xpto', 'TAG'), '1.0')
+    self.assertEqual(self.bg.env_get('xpto', 'TAG'), '1.0')
+    self.assertEqual(len(httpretty.HTTPretty.latest_requests), 1)
+
+    self.bg.env_set('xpto', 'TAG', '1.0')
+    self.assertEqual(self.bg.env_get('xpto', 'TAG'), '1.0')
+    self.assertEqual(len(httpretty.HTTPretty.latest_requests), 3)
+
   @httpretty.activate
   def test_remove_units_should_return_true_when_removes_web_units(self):
     self.bg.total_units = Mock(side_effect=self.mock_total_units([{'web': 2}, {'web': 0}]))
@@ -273,7 +454,7 @@ class TestBlueGreen(unittest.TestCase):
     self.assertFalse(self.bg.remove_units('xpto'))
 
     requests = httpretty.HTTPretty.latest_requests
-    self.assertEqual(len(requests), 6)
+    self.assertEqual(len(requests), 8)
 
   @httpretty.activate
   def test_remove_units_should_return_true_even_if_it_fails_at_firts_try(self):
@@ -295,7 +476,245 @@ class TestBlueGreen(unittest.TestCase):
     self.assertTrue(self.bg.remove_units('xpto'))
 
     requests = httpretty.HTTPretty.latest_requests
-    self.assertEqual(len(requests), 5)
+    self.assertEqual(len(requests), 7)
+
+  @httpretty.activate
+  def test_remove_units_retries_as_soon_as_running_events_finish(self):
+    self.bg.retry_sleep = 60
+    self.bg.total_units = MagicMock(return_value={'web': 1})
+
+    httpretty.register_uri(httpretty.DELETE, 'http://tsuruhost.com/apps/xpto/units',
+                           data='',
+                           responses=[
+                             httpretty.Response(body='', status=409),
+                             httpretty.Response(body='', status=200)
+                           ])
+
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           responses=[
+                             httpretty.Response(body='[{"UniqueID": "1", "Running": true}]', status=200),
+                             httpretty.Response(body='', status=204)
+                           ])
+
+    started = time.time()
+    self.assertTrue(self.bg.remove_units('xpto'))
+    self.assertLess(time.time() - started, 5)
+
+  @httpretty.activate
+  def test_remove_units_backs_off_when_no_event_is_running(self):
+    self.bg.retry_times = 2
+    self.bg.retry_sleep = 0.2
+    self.bg.total_units = MagicMock(return_value={'web': 1})
+
+    httpretty.register_uri(httpretty.DELETE, 'http://tsuruhost.com/apps/xpto/units',
+                           data='',
+                           status=500)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body='',
+                           status=204)
+
+    started = time.time()
+    self.assertFalse(self.bg.remove_units('xpto'))
+    # at least half of each delay: 0.1s, then 0.2s
+    self.assertGreaterEqual(time.time() - started, 0.3)
+
+  @httpretty.activate
+  def test_remove_units_stops_retrying_at_deadline(self):
+    self.bg.retry_times = 100
+    self.bg.retry_sleep = 1
+    self.bg.retry_deadline = 0.2
+    self.bg.total_units = MagicMock(return_value={'web': 1})
+    self.bg.has_running_events = MagicMock(return_value=True)
+
+    httpretty.register_uri(httpretty.DELETE, 'http://tsuruhost.com/apps/xpto/units',
+                           data='',
+                           status=409)
+
+    self.assertFalse(self.bg.remove_units('xpto'))
+    self.assertLess(len(httpretty.HTTPretty.latest_requests), 5)
+
+  @httpretty.activate
+  def test_running_events_are_fetched_incrementally(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           responses=[
+                             httpretty.Response(body='[{"UniqueID": "1", "Running": true, "StartTime": "2020-10-18T10:00:05.5-03:00"}]', status=200),
+                             httpretty.Response(body='[{"UniqueID": "1", "Running": false, "StartTime": "2020-10-18T10:00:05.5-03:00"}]', status=200),
+                             httpretty.Response(body='', status=204)
+                           ])
+
+    self.assertTrue(self.bg.has_running_events('xpto'))
+    self.assertFalse(self.bg.has_running_events('xpto'))
+    self.assertFalse(self.bg.has_running_events('xpto'))
+
+    requests = httpretty.HTTPretty.latest_requests
+    self.assertEqual(requests[0].querystring, {'target.value': ['xpto'], 'running': ['true']})
+    self.assertEqual(requests[1].querystring, {'target.value': ['xpto'], 'since': ['2020-10-18T13:00:05Z']})
+    self.assertNotIn('running', requests[2].querystring)
+
+  def test_parse_event_time(self):
+    self.assertEqual(parse_event_time('1970-01-01T00:01:00.25Z'), 60.25)
+    self.assertEqual(parse_event_time('1970-01-01T00:01:00-03:00'), 60 + 3 * 3600)
+    self.assertIsNone(parse_event_time('yesterday'))
+
+  @httpretty.activate
+  def test_add_units_trusts_a_finished_unit_add_event(self):
+    self.bg.total_units = MagicMock(return_value={'web': 1})
+
+    httpretty.register_uri(httpretty.PUT, 'http://tsuruhost.com/apps/xpto/units',
+                           data='',
+                           status=200)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body=json.dumps([{'UniqueID': '1', 'Running': False, 'Error': '',
+                                             'Kind': {'Name': 'app.update.unit.add'},
+                                             'CustomData': [{'name': 'units', 'value': '1'}, {'name': 'process', 'value': 'web'}]}]))
+
+    self.assertTrue(self.bg.add_units('xpto', {'web': 2}))
+    self.bg.total_units.assert_called_once_with('xpto')
+
+  @httpretty.activate
+  def test_add_units_fails_when_the_unit_add_event_failed(self):
+    self.bg.total_units = MagicMock(return_value={'web': 1})
+
+    httpretty.register_uri(httpretty.PUT, 'http://tsuruhost.com/apps/xpto/units',
+                           data='',
+                           status=200)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body=json.dumps([{'UniqueID': '1', 'Running': False, 'Error': 'quota exceeded',
+                                             'Kind': {'Name': 'app.update.unit.add'},
+                                             'CustomData': [{'name': 'process', 'value': 'web'}]}]))
+
+    self.assertFalse(self.bg.add_units('xpto', {'web': 2}))
+
+  @httpretty.activate
+  def test_remove_units_does_not_repeat_a_removal_its_event_shows_done(self):
+    self.bg.total_units = MagicMock(return_value={'web': 1})
+
+    httpretty.register_uri(httpretty.DELETE, 'http://tsuruhost.com/apps/xpto/units',
+                           data='',
+                           status=504)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body=json.dumps([{'UniqueID': '1', 'Running': False, 'Error': '',
+                                             'Kind': {'Name': 'app.update.unit.remove'},
+                                             'CustomData': [{'name': 'process', 'value': 'web'}]}]))
+
+    self.assertTrue(self.bg.remove_units('xpto'))
+    self.assertEqual([request.method for request in httpretty.HTTPretty.latest_requests], ['DELETE', 'GET'])
+
+  @httpretty.activate
+  def test_has_running_events(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           responses=[
+                             httpretty.Response(body='[{"Running": true}]', status=200),
+                             httpretty.Response(body='', status=204),
+                             httpretty.Response(body='[]', status=200)
+                           ])
+
+    self.assertTrue(self.bg.has_running_events('xpto'))
+    self.assertFalse(self.bg.has_running_events('xpto'))
+    self.assertFalse(self.bg.has_running_events('xpto'))
+
+  def test_backoff_delay_grows_exponentially_up_to_max_sleep(self):
+    self.bg.retry_sleep = 2
+    self.bg.retry_max_sleep = 10
+
+    self.assertTrue(1 <= self.bg.backoff_delay(1) <= 2)
+    self.assertTrue(4 <= self.bg.backoff_delay(3) <= 8)
+    self.assertTrue(5 <= self.bg.backoff_delay(10) <= 10)
+
+  @httpretty.activate
+  def test_wait_units_ready_reports_time_per_process_type(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
+                           responses=[
+                             httpretty.Response(body='{"units":[{"ProcessName": "web", "Status": "starting"}, {"ProcessName": "resque", "Status": "started"}]}'),
+                             httpretty.Response(body='{"units":[{"ProcessName": "web", "Status": "started"}, {"ProcessName": "resque", "Status": "started"}]}')
+                           ])
+
+    ready_after = self.bg.wait_units_ready('xpto', 5)
+
+    self.assertEqual(sorted(ready_after.keys()), ['resque', 'web'])
+    self.assertLess(ready_after['resque'], ready_after['web'])
+    self.assertEqual(len(httpretty.HTTPretty.latest_requests), 2)
+
+  @httpretty.activate
+  def test_wait_units_ready_returns_none_after_timeout(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
+                           body='{"units":[{"ProcessName": "web", "Status": "building"}]}')
+
+    self.assertIsNone(self.bg.wait_units_ready('xpto', 0.1))
+
+  @patch('subprocess.Popen', return_value=Mock(pid=1234))
+  def test_start_drain_spawns_detached_worker(self, subprocess_):
+    self.bg.state_dir = tempfile.mkdtemp()
+    try:
+      self.assertEqual(self.bg.start_drain('test-blue'), 1234)
+
+      arguments = subprocess_.call_args[0][0]
+      self.assertEqual(arguments[-3:], ['drain', '--app', 'test-blue'])
+      self.assertEqual(self.bg.drain_status('test-blue')['state'], 'pending')
+      with open(self.bg.drain_state_path('test-blue')) as state_file:
+        self.assertNotIn('newrelic', json.load(state_file)['config'])
+    finally:
+      shutil.rmtree(self.bg.state_dir)
+
+  @patch('subprocess.Popen')
+  def test_start_drain_leaves_a_running_drain_alone(self, subprocess_):
+    self.bg.state_dir = tempfile.mkdtemp()
+    try:
+      write_state(self.bg.drain_state_path('test-blue'), {'app': 'test-blue', 'state': 'running', 'pid': os.getpid()})
+
+      self.assertEqual(self.bg.start_drain('test-blue'), os.getpid())
+      self.assertFalse(subprocess_.called)
+    finally:
+      shutil.rmtree(self.bg.state_dir)
+
+  def test_drain_running_checks_the_worker_process(self):
+    self.bg.state_dir = tempfile.mkdtemp()
+    try:
+      finished = subprocess.Popen(['true'])
+      finished.wait()
+      for state, running in [({'state': 'pending', 'started_at': time.time()}, True),
+                             ({'state': 'pending', 'started_at': time.time() - 3600}, False),
+                             ({'state': 'running', 'pid': os.getpid()}, True),
+                             ({'state': 'running', 'pid': finished.pid}, False),
+                             ({'state': 'done', 'pid': os.getpid()}, False)]:
+        write_state(self.bg.drain_state_path('test-blue'), dict(state, app='test-blue'))
+        self.assertEqual(self.bg.drain_running('test-blue'), running, state)
+    finally:
+      shutil.rmtree(self.bg.state_dir)
+
+  def test_deploy_pre_aborts_while_the_app_is_drained_in_background(self):
+    self.bg.state_dir = tempfile.mkdtemp()
+    try:
+      write_state(self.bg.drain_state_path('test-blue'), {'app': 'test-blue', 'state': 'running', 'pid': os.getpid()})
+      self.bg.wait_for_drain = MagicMock(return_value=False)
+      self.bg.remove_units = MagicMock()
+      self.bg.env_set_many = MagicMock()
+      self.bg.build_hash = MagicMock(return_value=None)
+      self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+      self.bg.run_deploy = MagicMock(return_value=0)
+      self.bg.run_hook = MagicMock(return_value=True)
+
+      self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True), 2)
+      self.bg.wait_for_drain.assert_called_once_with('test-blue')
+      self.assertFalse(self.bg.remove_units.called)
+      self.assertFalse(self.bg.run_deploy.called)
+    finally:
+      shutil.rmtree(self.bg.state_dir)
+
+  def test_drain_records_progress_in_state_file(self):
+    self.bg.state_dir = tempfile.mkdtemp()
+    try:
+      self.bg.total_units = Mock(side_effect=self.mock_total_units([{'web': 2}, {}]))
+      self.bg.remove_units = MagicMock(return_value=True)
+
+      self.assertTrue(self.bg.drain('test-blue'))
+
+      state = self.bg.drain_status('test-blue')
+      self.assertEqual(state['state'], 'done')
+      self.assertEqual(state['units'], {})
+      self.assertNotIn('config', state)
+    finally:
+      shutil.rmtree(self.bg.state_dir)
 
   @httpretty.activate
   def test_add_units_should_return_true_when_adds_web_units(self):
@@ -304,10 +723,14 @@ class TestBlueGreen(unittest.TestCase):
     httpretty.register_uri(httpretty.PUT, 'http://tsuruhost.com/apps/xpto/units',
                            data='',
                            status=200)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body='',
+                           status=204)
 
     self.assertTrue(self.bg.add_units('xpto', {'web': 2}))
 
-    self.assertEqual({"units": ["1"], "process": ["web"]}, httpretty.last_request().querystring)
+    requests = [request for request in httpretty.HTTPretty.latest_requests if request.method == 'PUT']
+    self.assertEqual({"units": ["1"], "process": ["web"]}, requests[0].querystring)
 
   @httpretty.activate
   def test_add_units_should_return_true_when_adds_web_and_resque_units(self):
@@ -316,10 +739,13 @@ class TestBlueGreen(unittest.TestCase):
     httpretty.register_uri(httpretty.PUT, 'http://tsuruhost.com/apps/xpto/units',
                            data='',
                            status=200)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body='',
+                           status=204)
 
     self.assertTrue(self.bg.add_units('xpto', {'web': 5, 'resque': 2}))
 
-    requests = httpretty.HTTPretty.latest_requests
+    requests = [request for request in httpretty.HTTPretty.latest_requests if request.method == 'PUT']
     self.assertEqual(len(requests), 2)
     self.assertEqual({"units": ["3"], "process": ["web"]}, requests[0].querystring)
     self.assertEqual({"units": ["1"], "process": ["resque"]}, requests[1].querystring)
@@ -331,10 +757,13 @@ class TestBlueGreen(unittest.TestCase):
     httpretty.register_uri(httpretty.PUT, 'http://tsuruhost.com/apps/xpto/units',
                            data='',
                            status=200)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body='',
+                           status=204)
 
     self.assertTrue(self.bg.add_units('xpto', {'web': 5, 'resque': 1}))
 
-    requests = httpretty.HTTPretty.latest_requests
+    requests = [request for request in httpretty.HTTPretty.latest_requests if request.method == 'PUT']
     self.assertEqual(len(requests), 1)
     self.assertEqual({"units": ["3"], "process": ["web"]}, requests[0].querystring)
 
@@ -358,12 +787,52 @@ class TestBlueGreen(unittest.TestCase):
                                httpretty.Response(body='', status=500),
                                httpretty.Response(body='', status=200)
                            ])
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/events',
+                           body='',
+                           status=204)
 
     self.assertFalse(self.bg.add_units('xpto', {'web': 3, 'resque': 2}))
 
-    requests = httpretty.HTTPretty.latest_requests
+    requests = [request for request in httpretty.HTTPretty.latest_requests if request.method == 'PUT']
     self.assertEqual(len(requests), 2)
 
+  def test_add_units_runs_process_types_concurrently(self):
+    self.bg.max_workers = 2
+    self.bg.total_units = MagicMock(return_value={})
+    both_started = threading.Event()
+    started = []
+    def add_units_per_process_type(app, units_to_add, total_units_after_add, process_name):
+      started.append(process_name)
+      if len(started) == 2:
+        both_started.set()
+      return both_started.wait(5)
+    self.bg.add_units_per_process_type = Mock(side_effect=add_units_per_process_type)
+
+    self.assertTrue(self.bg.add_units('xpto', {'web': 2, 'resque': 1}))
+    self.assertEqual(sorted(started), ['resque', 'web'])
+
+  def test_remove_units_returns_false_when_any_concurrent_removal_fails(self):
+    self.bg.max_workers = 4
+    self.bg.total_units = MagicMock(return_value={'web': 2, 'resque': 1, 'worker': 1})
+    self.bg.remove_units_per_process_type = Mock(side_effect=lambda app, units, process_name: process_name != 'resque')
+
+    self.assertFalse(self.bg.remove_units('xpto'))
+    self.assertEqual(self.bg.remove_units_per_process_type.call_count, 3)
+
+  def test_scale_retries_serialized_when_app_is_locked(self):
+    self.bg.max_workers = 2
+    calls = []
+    def operation():
+      calls.append(self.bg.lock_conflict.is_set())
+      if len(calls) == 1:
+        self.bg.local.conflict = True
+        self.bg.lock_conflict.set()
+        return False
+      return True
+
+    self.assertEqual(self.bg.scale([operation]), [True])
+    self.assertEqual(calls, [False, True])
+
   @httpretty.activate
   def test_notify_newrelic_when_config_defined(self):
     httpretty.register_uri(httpretty.POST, 'http://api.newrelic.com/v2/applications/123/deployments.json',
@@ -434,6 +903,118 @@ class TestBlueGreen(unittest.TestCase):
                            status=500)
     self.assertFalse(self.bg.run_webhook('1.0'))
 
+  def test_start_notifications_runs_all_notifiers(self):
+    self.bg.notify_newrelic = MagicMock(return_value=True)
+    self.bg.notify_grafana = MagicMock(return_value=False)
+    self.bg.run_webhook = MagicMock(side_effect=socket.timeout('timed out'))
+
+    report = self.bg.join_notifications(self.bg.start_notifications('test-green', '1.0'), 5)
+
+    self.bg.notify_newrelic.assert_called_once_with('1.0')
+    self.bg.notify_grafana.assert_called_once_with('test-green', '1.0')
+    self.assertEqual(report['New Relic']['outcome'], 'ok')
+    self.assertEqual(report['Grafana']['outcome'], 'failed')
+    self.assertEqual(report['WebHook'], {'outcome': 'timeout', 'error': 'timed out', 'elapsed': report['WebHook']['elapsed']})
+
+  def test_start_notifications_leaves_out_unconfigured_notifiers(self):
+    self.bg.grafana = {}
+    self.bg.webhook = {'endpoint': 'http://example.com'}
+    self.bg.notify_newrelic = MagicMock(return_value=True)
+    self.bg.notify_grafana = MagicMock(return_value=True)
+    self.bg.run_webhook = MagicMock(return_value=True)
+
+    report = self.bg.join_notifications(self.bg.start_notifications('test-green', '1.0'), 5)
+
+    self.assertEqual(report.keys(), ['New Relic'])
+    self.assertFalse(self.bg.notify_grafana.called)
+    self.assertFalse(self.bg.run_webhook.called)
+
+  def test_join_notifications_keeps_error_text_out_of_the_outcome(self):
+    self.bg.notify_newrelic = MagicMock(side_effect=ValueError('bad "key"'))
+    self.bg.notify_grafana = MagicMock(return_value=True)
+    self.bg.run_webhook = MagicMock(return_value=True)
+
+    report = self.bg.join_notifications(self.bg.start_notifications('test-green', '1.0'), 5)
+
+    self.assertEqual(report['New Relic']['outcome'], 'error')
+    self.assertEqual(report['New Relic']['error'], 'bad "key"')
+    self.assertIn('tsuru_bluegreen_notification_duration_seconds{app="test-app",notifier="New Relic",outcome="error"}',
+                  self.bg.metrics.prometheus())
+
+  def test_join_notifications_doesnt_wait_past_deadline(self):
+    release = threading.Event()
+    self.bg.notify_newrelic = Mock(side_effect=lambda tag: release.wait(5))
+    self.bg.notify_grafana = MagicMock(return_value=True)
+    self.bg.run_webhook = MagicMock(return_value=True)
+
+    report = self.bg.join_notifications(self.bg.start_notifications('test-green', '1.0'), 0.1)
+    release.set()
+
+    self.assertEqual(report['New Relic']['outcome'], 'timeout')
+    self.assertEqual(report['WebHook']['outcome'], 'ok')
+
+  def test_path_template_removes_app_names_and_query(self):
+    self.assertEqual(path_template('/apps/xpto/units?units=2&process=web'), '/apps/{app}/units')
+    self.assertEqual(path_template('/apps/xpto'), '/apps/{app}')
+    self.assertEqual(path_template('/events?target.value=xpto&running=true'), '/events')
+
+  @httpretty.activate
+  def test_requests_are_recorded_in_metrics(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
+                           body='{"cname":["cname1", "cname2"]}')
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/other',
+                           body='{"cname":[]}')
+
+    self.bg.get_cname('xpto')
+    self.bg.get_cname('other')
+
+    summary = self.bg.metrics.request_summary()
+    self.assertEqual(len(summary), 1)
+    self.assertEqual((summary[0]['method'], summary[0]['path'], summary[0]['status'], summary[0]['count']),
+                     ('GET', '/apps/{app}', 200, 2))
+
+  def test_run_hook_records_its_duration(self):
+    self.bg.run_hook('before_pre')
+    self.bg.run_hook('after_swap')
+
+    self.assertEqual([(hook['name'], hook['succeeded']) for hook in self.bg.metrics.hooks],
+                     [('before_pre', True), ('after_swap', False)])
+
+  def test_metrics_prometheus_textfile(self):
+    metrics = Metrics('test-app')
+    with metrics.phase('swap'):
+      pass
+    metrics.record_request('DELETE', '/apps/test-app-blue/units?units=1', 409, 0.5)
+    metrics.record_retry('remove_units')
+
+    text = metrics.prometheus()
+
+    self.assertIn('# TYPE tsuru_bluegreen_phase_duration_seconds gauge', text)
+    self.assertIn('tsuru_bluegreen_http_requests_total{app="test-app",method="DELETE",path="/apps/{app}/units",status="409"} 1.0', text)
+    self.assertIn('tsuru_bluegreen_retries_total{app="test-app",operation="remove_units"} 1.0', text)
+
+  def test_metrics_prometheus_escapes_label_values(self):
+    metrics = Metrics('test-app')
+    metrics.record_retry('back\\slash "quoted"\nnewline')
+
+    self.assertIn('tsuru_bluegreen_retries_total{app="test-app",operation="back\\\\slash \\"quoted\\"\\nnewline"} 1.0',
+                  metrics.prometheus())
+
+  def test_export_metrics_writes_configured_files(self):
+    directory = tempfile.mkdtemp()
+    try:
+      self.bg.metrics_config = {'json_report': os.path.join(directory, '{app}.json'),
+                                'prometheus_textfile': os.path.join(directory, 'bluegreen.prom')}
+      self.bg.export_metrics()
+
+      with open(os.path.join(directory, 'test-app.json')) as report_file:
+        report = json.load(report_file)
+      self.assertEqual(report['app'], 'test-app')
+      self.assertEqual(report['stats']['connections']['new'], 0)
+      self.assertTrue(os.path.exists(os.path.join(directory, 'bluegreen.prom')))
+    finally:
+      shutil.rmtree(directory)
+
   def test_run_command_should_return_true_on_success(self):
     self.assertTrue(self.bg.run_command('echo test'))
 
@@ -447,6 +1028,40 @@ class TestBlueGreen(unittest.TestCase):
     self.assertTrue(self.bg.run_command('./test/env_test.sh', {'VAR': '0'}))
     self.assertFalse(self.bg.run_command('./test/env_test.sh', {'VAR': '1'}))
 
+  def test_run_command_should_return_false_on_non_string_environment_values(self):
+    self.assertFalse(self.bg.run_command('true', {'TAG': None}))
+
+  def test_run_commands_runs_commands_concurrently(self):
+    started = time.time()
+    self.assertTrue(self.bg.run_commands(['sleep 0.3', 'sleep 0.3', 'sleep 0.3']))
+    self.assertLess(time.time() - started, 0.8)
+
+  def test_run_commands_fails_fast_when_a_required_command_fails(self):
+    started = time.time()
+    self.assertFalse(self.bg.run_commands(['sleep 5', 'false']))
+    self.assertLess(time.time() - started, 2)
+
+  def test_run_commands_ignores_failing_optional_commands(self):
+    self.assertTrue(self.bg.run_commands(['-false', '- undefined_command', 'true']))
+
+  def test_run_commands_kills_commands_after_timeout(self):
+    started = time.time()
+    self.assertFalse(self.bg.run_commands(['sleep 5'], None, 0.2))
+    self.assertLess(time.time() - started, 2)
+
+  def test_run_commands_does_not_split_quoted_arguments(self):
+    self.assertTrue(self.bg.run_commands(['test "a b" = "a b"']))
+
+  def test_run_hook_runs_every_line_of_the_hook(self):
+    directory = tempfile.mkdtemp()
+    try:
+      self.bg.hooks = {'before_swap': 'touch %s/one\n-false\ntouch %s/two' % (directory, directory)}
+
+      self.assertTrue(self.bg.run_hook('before_swap'))
+      self.assertEqual(sorted(os.listdir(directory)), ['one', 'two'])
+    finally:
+      shutil.rmtree(directory)
+
   def test_run_hook_should_return_true_on_successful_command(self):
     self.assertTrue(self.bg.run_hook('before_pre'))
 
@@ -459,7 +1074,9 @@ class TestBlueGreen(unittest.TestCase):
   @patch('subprocess.Popen', return_value=Mock())
   def test_deploy_pre_should_return_zero_when_success(self, subprocess_):
     self.bg.remove_units = MagicMock()
-    self.bg.env_set = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
     self.bg.run_hook = MagicMock(return_value=True)
 
     subprocess_.return_value.stdout.readline.return_value = ''
@@ -471,7 +1088,9 @@ class TestBlueGreen(unittest.TestCase):
   @patch('subprocess.Popen', return_value=Mock())
   def test_deploy_pre_should_return_non_zero_when_fails(self, subprocess_):
     self.bg.remove_units = MagicMock()
-    self.bg.env_set = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
     self.bg.run_hook = MagicMock(return_value=True)
 
     subprocess_.return_value.stdout.readline.return_value = ''
@@ -480,11 +1099,379 @@ class TestBlueGreen(unittest.TestCase):
 
     self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True), 2)
 
+  @patch('subprocess.Popen', return_value=Mock())
+  def test_deploy_pre_prewarms_units_when_enabled(self, subprocess_):
+    self.bg.prewarm = True
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.total_units = MagicMock(return_value={'web': 4})
+    self.bg.add_units = MagicMock(return_value=True)
+    self.bg.wait_units_ready = MagicMock(return_value={'web': 1.5})
+
+    subprocess_.return_value.stdout.readline.return_value = ''
+    subprocess_.return_value.returncode = 0
+
+    self.assertEqual(self.bg.deploy_pre('test-green', 'master', True, 'test-blue'), 0)
+    self.bg.total_units.assert_called_once_with('test-blue')
+    self.bg.add_units.assert_called_once_with('test-green', {'web': 4})
+
+  @patch('subprocess.Popen', return_value=Mock())
+  def test_deploy_pre_should_return_non_zero_when_prewarm_fails(self, subprocess_):
+    self.bg.prewarm = True
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.total_units = MagicMock(return_value={'web': 4})
+    self.bg.add_units = MagicMock(return_value=True)
+    self.bg.wait_units_ready = MagicMock(return_value=None)
+
+    subprocess_.return_value.stdout.readline.return_value = ''
+    subprocess_.return_value.returncode = 0
+
+    self.assertEqual(self.bg.deploy_pre('test-green', 'master', True, 'test-blue'), 2)
+
+  def test_deploy_pre_resumes_after_the_deploy(self):
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.run_deploy = MagicMock(return_value=0)
+    self.bg.run_hook = MagicMock(side_effect=lambda name, env: name != 'after_pre')
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True), 2)
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True), 0)
+
+    self.assertEqual(self.bg.run_deploy.call_count, 1)
+    self.bg.run_hook.assert_called_once_with('after_pre', ANY)
+    with open(self.bg.journal_path()) as journal:
+      self.assertEqual(json.load(journal)['state'], 'done')
+
+  def test_deploy_pre_deploys_again_after_a_failed_deploy(self):
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.run_deploy = MagicMock(side_effect=[1, 0])
+    self.bg.run_hook = MagicMock(side_effect=lambda name, env: name != 'after_pre')
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True), 2)
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True), 0)
+
+    self.assertEqual(self.bg.run_deploy.call_count, 2)
+    self.assertEqual(self.bg.remove_units.call_count, 1)
+
+  def test_deploy_pre_refetches_the_app_after_the_deploy(self):
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.run_deploy = MagicMock(side_effect=lambda arguments, app, tag: self.bg.app_cache.update({app: {'units': []}}) or 0)
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True), 0)
+    self.assertNotIn('test-blue', self.bg.app_cache)
+
+  def test_deploy_pre_force_ignores_an_unfinished_journal(self):
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.run_deploy = MagicMock(return_value=0)
+    self.bg.run_hook = MagicMock(side_effect=lambda name, env: name != 'after_pre')
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True), 2)
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'master', True, force=True), 2)
+    self.assertEqual(self.bg.run_deploy.call_count, 2)
+
+  def test_stream_deploy_output_keeps_one_line_without_a_tail(self):
+    directory = tempfile.mkdtemp()
+    try:
+      process = subprocess.Popen(['sh', '-c', 'seq 1 5000'], stdout=subprocess.PIPE)
+
+      self.assertEqual(self.bg.stream_deploy_output(process, os.path.join(directory, 'deploy.log.gz'), 0), ['5000'])
+    finally:
+      shutil.rmtree(directory)
+
+  def test_stream_deploy_output_keeps_bounded_tail_and_compressed_log(self):
+    directory = tempfile.mkdtemp()
+    try:
+      log_path = os.path.join(directory, 'deploy.log.gz')
+      process = subprocess.Popen(['sh', '-c', 'seq 1 5000'], stdout=subprocess.PIPE)
+
+      tail = self.bg.stream_deploy_output(process, log_path, 3)
+
+      self.assertEqual(tail, ['4998', '4999', '5000'])
+      log = gzip.open(log_path)
+      self.assertEqual(len(log.read().splitlines()), 5000)
+      log.close()
+    finally:
+      shutil.rmtree(directory)
+
+  def test_run_deploy_returns_status_and_writes_log(self):
+    directory = tempfile.mkdtemp()
+    try:
+      self.bg.deploy_log = {'directory': directory, 'tail_lines': 10}
+
+      self.assertEqual(self.bg.run_deploy(['sh', '-c', 'echo building; echo broken >&2; exit 3'], 'test-blue', 'release/1.0'), 3)
+
+      logs = os.listdir(directory)
+      self.assertEqual(len(logs), 1)
+      self.assertTrue(logs[0].startswith('test-blue-release_1.0-'))
+      log = gzip.open(os.path.join(directory, logs[0]))
+      self.assertEqual(log.read(), 'building\nbroken\n')
+      log.close()
+    finally:
+      shutil.rmtree(directory)
+
+  @patch('subprocess.Popen', return_value=Mock())
+  def test_deploy_pre_stamps_deploy_metadata(self, subprocess_):
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.deploy_metadata = MagicMock(return_value={'TAG': 'v1', 'BLUEGREEN_BUILD_ID': '42'})
+
+    subprocess_.return_value.stdout.readline.return_value = ''
+    subprocess_.return_value.returncode = 0
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v1', True), 0)
+    self.bg.env_set_many.assert_called_once_with('test-blue', {'TAG': 'v1', 'BLUEGREEN_BUILD_ID': '42',
+                                                               'BLUEGREEN_COMMIT': '', 'BLUEGREEN_DEPLOYED_AT': ''})
+    self.bg.run_hook.assert_any_call('before_pre', {'TAG': 'v1', 'BLUEGREEN_BUILD_ID': '42'})
+
+  def test_deploy_pre_skips_deploy_when_pre_already_runs_the_build(self):
+    self.bg.build_hash = MagicMock(return_value='sha1:abc')
+    self.bg.env_get_many = MagicMock(return_value={'TAG': 'v1', 'BLUEGREEN_BUILD_HASH': 'sha1:abc'})
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.run_deploy = MagicMock()
+    self.bg.run_hook = MagicMock(return_value=True)
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v1', True), 0)
+    self.bg.env_get_many.assert_called_once_with('test-blue', ['TAG', 'BLUEGREEN_BUILD_HASH', 'BLUEGREEN_IMAGE'])
+    self.assertFalse(self.bg.remove_units.called)
+    self.assertFalse(self.bg.env_set_many.called)
+    self.assertFalse(self.bg.run_deploy.called)
+    self.assertEqual([call[0][0] for call in self.bg.run_hook.call_args_list], ['after_pre'])
+
+  def test_deploy_pre_force_deploys_the_same_build_again(self):
+    self.bg.build_hash = MagicMock(return_value='sha1:abc')
+    self.bg.env_get_many = MagicMock(return_value={'TAG': 'v1', 'BLUEGREEN_BUILD_HASH': 'sha1:abc'})
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.run_deploy = MagicMock(return_value=0)
+    self.bg.run_hook = MagicMock(return_value=True)
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v1', True, force=True), 0)
+    self.assertFalse(self.bg.env_get_many.called)
+    self.assertTrue(self.bg.run_deploy.called)
+
+  def test_deploy_pre_stamps_build_hash_only_after_a_successful_deploy(self):
+    self.bg.deploy_metadata = MagicMock(return_value={'TAG': 'v2'})
+    self.bg.build_hash = MagicMock(return_value='sha1:abc')
+    self.bg.env_get_many = MagicMock(return_value={'TAG': 'v1', 'BLUEGREEN_BUILD_HASH': 'sha1:old'})
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.run_hook = MagicMock(return_value=True)
+
+    self.bg.run_deploy = MagicMock(return_value=2)
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v2', True), 2)
+    self.bg.env_set_many.assert_called_once_with('test-blue', {'TAG': 'v2', 'BLUEGREEN_BUILD_HASH': '', 'BLUEGREEN_COMMIT': '',
+                                                               'BLUEGREEN_BUILD_ID': '', 'BLUEGREEN_DEPLOYED_AT': ''})
+
+    self.bg.env_set_many.reset_mock()
+    self.bg.run_deploy = MagicMock(return_value=0)
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v2', True), 0)
+    self.assertEqual(self.bg.env_set_many.call_args_list[-1][0], ('test-blue', {'BLUEGREEN_BUILD_HASH': 'sha1:abc'}))
+
+  def test_build_hash_follows_deploy_dir_contents(self):
+    directory = tempfile.mkdtemp()
+    try:
+      os.makedirs(os.path.join(directory, 'build', '.git'))
+      with open(os.path.join(directory, 'build', 'app.py'), 'w') as source:
+        source.write('print 1\n')
+      self.bg.deploy_dir = os.path.join(directory, 'build')
+
+      first = self.bg.build_hash('v1', True, {})
+      with open(os.path.join(directory, 'build', '.git', 'HEAD'), 'w') as head:
+        head.write('ref: refs/heads/master\n')
+      self.assertEqual(self.bg.build_hash('v1', True, {}), first)
+
+      with open(os.path.join(directory, 'build', 'app.py'), 'w') as source:
+        source.write('print 2\n')
+      self.assertNotEqual(self.bg.build_hash('v1', True, {}), first)
+      self.assertTrue(first.startswith('sha1:'))
+    finally:
+      shutil.rmtree(directory)
+
+  def test_build_hash_of_git_deploys_is_the_commit(self):
+    self.assertEqual(self.bg.build_hash('v1', False, {'BLUEGREEN_COMMIT': 'abc123'}), 'git:abc123')
+    self.assertEqual(self.bg.build_hash('v1', False, {}), None)
+
+  def test_build_hash_is_unknown_when_deploy_dir_is_missing(self):
+    self.bg.deploy_dir = '/nonexistent/build'
+    self.assertEqual(self.bg.build_hash('v1', True, {}), None)
+
+  def promote_state(self, states):
+    self.bg.deploy_strategy = 'promote'
+    self.bg.deploy_metadata = MagicMock(return_value={'TAG': 'v2'})
+    self.bg.build_hash = MagicMock(return_value='sha1:abc')
+    self.bg.env_get_many = MagicMock(side_effect=lambda app, keys: states[app])
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.latest_image = MagicMock(return_value='registry/app:v9')
+
+  def test_deploy_pre_promotes_the_image_built_for_the_tag_on_the_live_app(self):
+    self.promote_state({
+      'test-green': {'TAG': 'v1', 'BLUEGREEN_BUILD_HASH': 'sha1:old', 'BLUEGREEN_IMAGE': 'registry/app:v5'},
+      'test-blue': {'TAG': 'v2', 'BLUEGREEN_BUILD_HASH': 'sha1:abc', 'BLUEGREEN_IMAGE': 'registry/app:v8'},
+    })
+    self.bg.run_deploy = MagicMock(return_value=0)
+
+    self.assertEqual(self.bg.deploy_pre('test-green', 'v2', True, 'test-blue'), 0)
+    self.bg.run_deploy.assert_called_once_with(['tsuru', 'app-deploy', '-a', 'test-green', '-i', 'registry/app:v8'], 'test-green', 'v2')
+    self.bg.env_set_many.assert_any_call('test-green', {'TAG': 'v2', 'BLUEGREEN_BUILD_HASH': '', 'BLUEGREEN_IMAGE': '',
+                                                        'BLUEGREEN_COMMIT': '', 'BLUEGREEN_BUILD_ID': '',
+                                                        'BLUEGREEN_DEPLOYED_AT': ''})
+    self.assertEqual(self.bg.env_set_many.call_args_list[-1][0],
+                     ('test-green', {'BLUEGREEN_BUILD_HASH': 'sha1:abc', 'BLUEGREEN_IMAGE': 'registry/app:v9'}))
+
+  def test_deploy_pre_builds_when_no_image_matches_the_build(self):
+    self.promote_state({
+      'test-green': {'TAG': 'v1', 'BLUEGREEN_BUILD_HASH': 'sha1:old', 'BLUEGREEN_IMAGE': 'registry/app:v5'},
+      'test-blue': {'TAG': 'v2', 'BLUEGREEN_BUILD_HASH': 'sha1:other', 'BLUEGREEN_IMAGE': 'registry/app:v8'},
+    })
+    self.bg.run_deploy = MagicMock(return_value=0)
+
+    self.assertEqual(self.bg.deploy_pre('test-green', 'v2', True, 'test-blue'), 0)
+    self.bg.run_deploy.assert_called_once_with(['tsuru', 'app-deploy', '-a', 'test-green', '.'], 'test-green', 'v2')
+
+  def test_deploy_pre_builds_when_promoting_fails(self):
+    self.promote_state({
+      'test-green': {'TAG': 'v1', 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None},
+      'test-blue': {'TAG': 'v2', 'BLUEGREEN_BUILD_HASH': 'sha1:abc', 'BLUEGREEN_IMAGE': 'registry/app:v8'},
+    })
+    self.bg.run_deploy = MagicMock(side_effect=[1, 0])
+
+    self.assertEqual(self.bg.deploy_pre('test-green', 'v2', True, 'test-blue'), 0)
+    self.assertEqual(self.bg.run_deploy.call_args_list[1][0][0], ['tsuru', 'app-deploy', '-a', 'test-green', '.'])
+
+  @httpretty.activate
+  def test_latest_image_returns_the_image_of_the_last_deploy(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/deploys',
+                           body='[{"App": "xpto", "Image": "registry/xpto:v3"}]')
+
+    self.assertEqual(self.bg.latest_image('xpto'), 'registry/xpto:v3')
+    self.assertEqual({'app': ['xpto'], 'limit': ['1']}, httpretty.last_request().querystring)
+
+  @httpretty.activate
+  def test_latest_image_returns_none_without_deploys(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/deploys', status=204, body='')
+
+    self.assertEqual(self.bg.latest_image('xpto'), None)
+
+  def test_deploy_pre_overlaps_unit_removal_env_write_and_before_pre_hook(self):
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.remove_units = MagicMock(side_effect=lambda app: time.sleep(0.3))
+    self.bg.env_set_many = MagicMock(side_effect=lambda app, envs: time.sleep(0.3))
+    self.bg.run_hook = MagicMock(side_effect=lambda name, env: time.sleep(0.3) or True)
+    self.bg.run_deploy = MagicMock(return_value=0)
+
+    started = time.time()
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v1', True), 0)
+    self.assertLess(time.time() - started, 0.8)
+
+  def test_deploy_pre_does_not_deploy_when_before_pre_hook_fails(self):
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.run_hook = MagicMock(side_effect=lambda name, env: name != 'before_pre')
+    self.bg.run_deploy = MagicMock(return_value=0)
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v1', True), 2)
+    self.assertFalse(self.bg.run_deploy.called)
+    self.assertEqual([call[0][0] for call in self.bg.run_hook.call_args_list], ['before_pre'])
+
+  def test_deploy_pre_runs_after_pre_hook_when_deploy_fails(self):
+    self.bg.build_hash = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_BUILD_HASH': None, 'BLUEGREEN_IMAGE': None})
+    self.bg.remove_units = MagicMock()
+    self.bg.env_set_many = MagicMock()
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.run_deploy = MagicMock(return_value=1)
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v1', True), 1)
+    self.bg.run_hook.assert_any_call('after_pre', {'TAG': 'v1', 'BLUEGREEN_DEPLOYED_AT': ANY})
+
+  def test_deploy_pre_dry_run_does_not_deploy(self):
+    self.bg.remove_units = MagicMock()
+    self.bg.run_deploy = MagicMock()
+    self.bg.run_hook = MagicMock()
+
+    self.assertEqual(self.bg.deploy_pre('test-blue', 'v1', True, dry_run=True), 0)
+    self.assertFalse(self.bg.remove_units.called)
+    self.assertFalse(self.bg.run_deploy.called)
+    self.assertFalse(self.bg.run_hook.called)
+
+  def test_critical_path_follows_the_slowest_chain_of_dependencies(self):
+    steps = [Step('a', None), Step('b', None), Step('c', None, ['a', 'b']), Step('d', None, ['a'])]
+    for step, elapsed in zip(steps, [1.0, 3.0, 2.0, 4.5]):
+      step.elapsed = elapsed
+
+    seconds, path = critical_path(steps)
+    self.assertEqual(seconds, 5.5)
+    self.assertEqual([step.name for step in path], ['a', 'd'])
+
+  def test_deploy_swap_records_its_critical_path(self):
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.total_units = MagicMock(return_value={'web': 3})
+    self.bg.swap = MagicMock(return_value=True)
+    self.bg.remove_units = MagicMock(side_effect=lambda app: time.sleep(0.1))
+    self.bg.start_notifications = MagicMock(return_value=[])
+
+    self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue']), 0)
+    self.assertEqual(self.bg.metrics.stats['critical_path']['steps'], ['before_swap', 'swap', 'remove_units', 'after_swap'])
+    self.assertIn('tsuru_bluegreen_critical_path_seconds{app="test-app"}', self.bg.metrics.prometheus())
+
+  def test_deploy_swap_leaves_missing_metadata_out_of_the_hook_env(self):
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None, 'BLUEGREEN_COMMIT': 'abc123'})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.total_units = MagicMock(return_value={'web': 3})
+    self.bg.swap = MagicMock(return_value=True)
+    self.bg.remove_units = MagicMock(return_value=True)
+    self.bg.start_notifications = MagicMock(return_value=[])
+
+    self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue']), 0)
+    self.bg.run_hook.assert_any_call('before_swap', {'BLUEGREEN_COMMIT': 'abc123'})
+
+  def test_deploy_metadata_includes_build_id(self):
+    os.environ['BUILD_ID'] = '42'
+    try:
+      metadata = self.bg.deploy_metadata('v1')
+    finally:
+      del os.environ['BUILD_ID']
+
+    self.assertEqual(metadata['TAG'], 'v1')
+    self.assertEqual(metadata['BLUEGREEN_BUILD_ID'], '42')
+    self.assertIn('BLUEGREEN_DEPLOYED_AT', metadata)
+
   def test_deploy_swap_should_return_zero_when_success(self):
-    self.bg.env_get = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None})
     self.bg.run_hook = MagicMock(return_value=True)
     self.bg.add_units = MagicMock(return_value=True)
-    self.bg.total_units = MagicMock(return_value=3)
+    self.bg.total_units = MagicMock(return_value={'web': 3})
     self.bg.swap = MagicMock(return_value=True)
     self.bg.remove_units = MagicMock()
     self.bg.notify_newrelic = MagicMock()
@@ -493,11 +1480,178 @@ class TestBlueGreen(unittest.TestCase):
     self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue', 'cname-green']), 0)
     self.bg.swap.assert_called_once_with('test-blue', 'test-green', False)
 
+  def test_rate_limiter_spaces_requests_beyond_the_burst(self):
+    limiter = RateLimiter(rate=20, burst=2)
+
+    started = time.time()
+    for _ in range(6):
+      limiter.acquire()
+      limiter.release()
+    self.assertGreaterEqual(time.time() - started, 0.15)
+    self.assertEqual(limiter.stats['requests'], 6)
+    self.assertGreaterEqual(limiter.stats['throttled'], 3)
+
+  def test_rate_limiter_caps_concurrent_requests(self):
+    limiter = RateLimiter(concurrency=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def second():
+      limiter.acquire()
+      acquired.set()
+    thread = threading.Thread(target=second)
+    thread.start()
+    self.assertFalse(acquired.wait(0.1))
+
+    limiter.release()
+    self.assertTrue(acquired.wait(1))
+    thread.join()
+
+  def test_rate_limiter_pause_holds_requests(self):
+    limiter = RateLimiter()
+    limiter.pause(0.2)
+
+    self.assertGreaterEqual(limiter.acquire(), 0.15)
+
+  def test_retry_after_accepts_seconds_and_http_dates(self):
+    self.assertEqual(retry_after('3', 1), 3)
+    self.assertEqual(retry_after(None, 1), 1)
+    self.assertEqual(retry_after('soon', 1), 1)
+    self.assertEqual(retry_after('Wed, 21 Oct 2015 07:28:00 GMT', 1), 0)
+    future = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 30))
+    self.assertTrue(25 <= retry_after(future, 1) <= 31)
+
+  @httpretty.activate
+  def test_request_retries_throttled_responses_after_retry_after(self):
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto',
+                           responses=[httpretty.Response(body='', status=429, adding_headers={'Retry-After': '0'}),
+                                      httpretty.Response(body='{"name": "xpto"}', status=200)])
+
+    self.assertEqual(self.bg.get('/apps/xpto').status, 200)
+    self.assertEqual(len(httpretty.HTTPretty.latest_requests), 2)
+    self.assertEqual(self.bg.limiter.stats['pauses'], 1)
+    self.assertEqual(self.bg.metrics.retries['throttled'], 1)
+
+  @httpretty.activate
+  def test_request_gives_up_on_throttled_responses_after_max_retries(self):
+    self.bg.rate_limit = dict(self.bg.rate_limit, max_retries=1, max_wait=0)
+    httpretty.register_uri(httpretty.GET, 'http://tsuruhost.com/apps/xpto', status=503, body='')
+
+    self.assertEqual(self.bg.get('/apps/xpto').status, 503)
+    self.assertEqual(len(httpretty.HTTPretty.latest_requests), 2)
+
+  def test_run_graph_runs_steps_after_their_dependencies(self):
+    order = []
+    steps = [Step('a', lambda: order.append('a')),
+             Step('b', lambda: order.append('b'), ['a']),
+             Step('c', lambda: order.append('c'), ['a', 'b'])]
+
+    run_graph(steps, 4)
+    self.assertEqual(order, ['a', 'b', 'c'])
+    self.assertEqual([step.status for step in steps], ['done', 'done', 'done'])
+
+  def test_run_graph_runs_independent_steps_concurrently(self):
+    barrier = threading.Event()
+    steps = [Step('a', lambda: barrier.wait(1)),
+             Step('b', lambda: barrier.set())]
+
+    started = time.time()
+    run_graph(steps, 2)
+    self.assertLess(time.time() - started, 0.5)
+
+  def test_run_graph_skips_dependents_of_failed_steps(self):
+    steps = [Step('a', lambda: False),
+             Step('b', MagicMock(), ['a']),
+             Step('c', MagicMock(), ['b']),
+             Step('d', MagicMock())]
+
+    for max_workers in [1, 4]:
+      run_graph(steps, max_workers)
+      self.assertEqual([step.status for step in steps], ['failed', 'skipped', 'skipped', 'done'])
+      self.assertFalse(steps[1].func.called)
+
+  def test_run_graph_does_not_skip_dependents_of_optional_steps(self):
+    steps = [Step('a', lambda: False, required=False),
+             Step('b', MagicMock(return_value=True), ['a'])]
+
+    run_graph(steps, 1)
+    self.assertEqual([step.status for step in steps], ['failed', 'done'])
+
+  def test_run_graph_reraises_step_errors(self):
+    steps = [Step('a', MagicMock(side_effect=ValueError('boom'))),
+             Step('b', MagicMock(), ['a'])]
+
+    self.assertRaises(ValueError, run_graph, steps, 2)
+    self.assertEqual(steps[1].status, 'skipped')
+
+  def test_run_graph_does_not_run_steps_already_done(self):
+    finished = []
+    steps = [Step('a', MagicMock()),
+             Step('b', MagicMock(), ['a'])]
+    steps[0].status = 'done'
+
+    for max_workers in [1, 4]:
+      steps[1].status = 'pending'
+      run_graph(steps, max_workers, finished.append)
+      self.assertFalse(steps[0].func.called)
+      self.assertEqual(steps[1].status, 'done')
+    self.assertEqual(finished, [steps[1], steps[1]])
+
+  def test_run_graph_starts_no_step_after_an_optional_step_raised(self):
+    steps = [Step('a', MagicMock(side_effect=IOError('connection reset')), required=False),
+             Step('b', lambda: time.sleep(0.1)),
+             Step('c', MagicMock(), ['a'])]
+
+    self.assertRaises(IOError, run_graph, steps, 4)
+    self.assertFalse(steps[2].func.called)
+
+  def test_run_graph_rejects_unknown_dependencies(self):
+    self.assertRaises(ValueError, run_graph, [Step('a', MagicMock(), ['b']), Step('b', MagicMock())], 1)
+
+  def test_plan_swap_lists_unit_deltas_and_call_estimates(self):
+    self.bg.env_get_many = MagicMock(return_value={'TAG': 'v2'})
+    self.bg.total_units = MagicMock(side_effect=lambda app: {'test-blue': {'web': 4, 'worker': 2},
+                                                             'test-green': {'web': 1}}[app])
+
+    plan = self.bg.plan_swap(['test-blue', 'test-green'], ['cname-blue'])
+
+    self.assertEqual([step.name for step in plan.steps],
+                     ['before_swap', 'add_units:web', 'add_units:worker', 'swap', 'notify',
+                      'remove_units', 'after_swap', 'join_notifications'])
+    self.assertEqual(plan.steps[1].description, "add 3 'web' units to test-green")
+    self.assertEqual(plan.steps[3].depends, ['add_units:web', 'add_units:worker'])
+    self.assertEqual(plan.calls, 2 + 2 + 1 + 3)
+
+  def test_deploy_swap_dry_run_does_not_change_apps(self):
+    self.bg.env_get_many = MagicMock(return_value={'TAG': 'v2'})
+    self.bg.total_units = MagicMock(return_value={'web': 3})
+    self.bg.run_hook = MagicMock()
+    self.bg.swap = MagicMock()
+
+    self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue'], dry_run=True), 0)
+    self.assertFalse(self.bg.run_hook.called)
+    self.assertFalse(self.bg.swap.called)
+
+  def test_deploy_swap_keeps_old_units_when_rolling_fails_after_swap(self):
+    self.bg.rolling_swap = {'enabled': True, 'max_surplus': 1, 'threshold': 0.5}
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.total_units = MagicMock(return_value={'web': 4})
+    self.bg.roll_units = MagicMock(side_effect=[True, False])
+    self.bg.swap = MagicMock(return_value=True)
+    self.bg.remove_units = MagicMock()
+    self.bg.start_notifications = MagicMock(return_value=[])
+
+    self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue', 'cname-green']), 2)
+    self.assertEqual(self.bg.roll_units.call_args_list[0][0], ('test-green', 'test-blue', {'web': 4}, {'web': 2}, 1))
+    self.assertEqual(self.bg.roll_units.call_args_list[1][0], ('test-green', 'test-blue', {'web': 4}, {'web': 4}, 0))
+    self.assertFalse(self.bg.remove_units.called)
+
   def test_deploy_swap_should_return_non_zero_when_fails(self):
-    self.bg.env_get = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None})
     self.bg.run_hook = MagicMock(return_value=True)
     self.bg.add_units = MagicMock(return_value=True)
-    self.bg.total_units = MagicMock(return_value=3)
+    self.bg.total_units = MagicMock(return_value={'web': 3})
     self.bg.swap = MagicMock(return_value=False)
     self.bg.remove_units = MagicMock()
     self.bg.notify_newrelic = MagicMock()
@@ -506,12 +1660,40 @@ class TestBlueGreen(unittest.TestCase):
     self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue', 'cname-green']), 2)
     self.bg.swap.assert_called_once_with('test-blue', 'test-green', False)
 
+  def test_deploy_swap_should_return_non_zero_when_units_are_not_ready(self):
+    self.bg.readiness_timeout = 1
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.add_units = MagicMock(return_value=True)
+    self.bg.total_units = MagicMock(return_value={'web': 3})
+    self.bg.wait_units_ready = MagicMock(return_value=None)
+    self.bg.swap = MagicMock(return_value=True)
+    self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue', 'cname-green']), 2)
+    self.bg.wait_units_ready.assert_called_once_with('test-green', 1)
+    self.assertFalse(self.bg.swap.called)
+
+  def test_deploy_swap_drains_old_app_in_background(self):
+    self.bg.drain_in_background = True
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None})
+    self.bg.run_hook = MagicMock(return_value=True)
+    self.bg.add_units = MagicMock(return_value=True)
+    self.bg.total_units = MagicMock(return_value={'web': 3})
+    self.bg.swap = MagicMock(return_value=True)
+    self.bg.start_drain = MagicMock()
+    self.bg.remove_units = MagicMock()
+    self.bg.notify_newrelic = MagicMock()
+    self.bg.notify_grafana = MagicMock()
+    self.bg.run_webhook = MagicMock()
+    self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue', 'cname-green']), 0)
+    self.bg.start_drain.assert_called_once_with('test-blue')
+    self.assertFalse(self.bg.remove_units.called)
+
   def test_swap_retries_should_return_zero_when_success(self):
     self.config['retry_times'] = 0
-    self.bg.env_get = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None})
     self.bg.run_hook = MagicMock(return_value=True)
     self.bg.add_units = MagicMock(return_value=True)
-    self.bg.total_units = MagicMock(return_value=3)
+    self.bg.total_units = MagicMock(return_value={'web': 3})
     self.bg.swap = MagicMock(return_value=True)
     self.bg.remove_units = MagicMock()
     self.bg.notify_newrelic = MagicMock()
@@ -521,10 +1703,10 @@ class TestBlueGreen(unittest.TestCase):
     self.bg.swap.assert_called_once_with('test-blue', 'test-green', False)
 
   def test_swap_retries_should_return_non_zero_when_fails(self):
-    self.bg.env_get = MagicMock(return_value=None)
+    self.bg.env_get_many = MagicMock(return_value={'TAG': None})
     self.bg.run_hook = MagicMock(return_value=True)
     self.bg.add_units = MagicMock(return_value=True)
-    self.bg.total_units = MagicMock(return_value=3)
+    self.bg.total_units = MagicMock(return_value={'web': 3})
     self.bg.swap = MagicMock(return_value=False)
     self.bg.remove_units = MagicMock()
     self.bg.notify_newrelic = MagicMock()
@@ -533,6 +1715,38 @@ class TestBlueGreen(unittest.TestCase):
     self.assertEqual(self.bg.deploy_swap(['test-blue', 'test-green'], ['cname-blue', 'cname-green']), 2)
     self.bg.swap.assert_called_once_with('test-blue', 'test-green', False)
 
+  @patch('bluegreen.BlueGreen')
+  def test_fleet_isolates_failing_apps(self, bluegreen_):
+    bluegreen_.return_value.discover.return_value = (['live', 'pre'], None)
+    bluegreen_.return_value.deploy_swap.side_effect = [0, Exception('boom'), 0]
+    configs = [dict(self.config, name=name) for name in ['one', 'two', 'three']]
+
+    fleet = Fleet('token', 'tsuruhost.com', configs, 1)
+
+    self.assertEqual(fleet.run('swap', 'master'), 2)
+    self.assertEqual(bluegreen_.return_value.deploy_swap.call_count, 3)
+
+  @patch('bluegreen.BlueGreen')
+  def test_fleet_exports_metrics_of_failing_apps(self, bluegreen_):
+    bluegreen_.return_value.discover.return_value = (['live', 'pre'], None)
+    bluegreen_.return_value.deploy_swap.side_effect = Exception('boom')
+
+    fleet = Fleet('token', 'tsuruhost.com', [self.config], 1)
+
+    self.assertEqual(fleet.run('swap', 'master'), 2)
+    self.assertEqual(bluegreen_.return_value.export_metrics.call_count, 1)
+
+  @patch('bluegreen.BlueGreen')
+  def test_fleet_returns_zero_when_every_app_succeeds(self, bluegreen_):
+    bluegreen_.return_value.discover.return_value = (['live', 'pre'], None)
+    bluegreen_.return_value.deploy_pre.return_value = 0
+    configs = [dict(self.config, name=name) for name in ['one', 'two', 'three']]
+
+    fleet = Fleet('token', 'tsuruhost.com', configs, 3)
+
+    self.assertEqual(fleet.run('pre', 'v1'), 0)
+    bluegreen_.return_value.deploy_pre.assert_called_with('pre', 'v1', True, 'live', False, False)
+
   def mock_total_units(self, values):
     calls = {'count': 0}
     def total_units(*args, **kwargs):
@@ -1,7 +1,10 @@
 import os
+import shutil
+import tempfile
 import unittest
 from mock import MagicMock
 from mock import Mock
+from mock import patch
 from bluegreen import BlueGreen, Config
 
 class TestConfig(unittest.TestCase):
@@ -20,6 +23,12 @@ class TestConfig(unittest.TestCase):
     self.assertEqual(None, self.config['hooks']['after_pre'])
     self.assertEqual(None, self.config['hooks']['before_swap'])
 
+  def test_load_multi_command_hooks(self):
+    config = Config.load('test/multi-command-hooks.ini')
+    self.assertEqual('./smoke.sh\n-./warm-cache.sh', config['hooks']['before_swap'])
+    self.assertEqual(120, config['hook_timeout'])
+    self.assertEqual(0, self.config['hook_timeout'])
+
   def test_load_newrelic_config(self):
     self.assertEqual('some-api-key', self.config['newrelic']['api_key'])
     self.assertEqual('123', self.config['newrelic']['app_id'])
@@ -46,6 +55,143 @@ class TestConfig(unittest.TestCase):
   def test_load_app_deploy_config(self):
     self.assertEqual("'.'", self.config['deploy_dir'])
 
+  def test_load_prewarm_config(self):
+    self.assertEqual(True, self.config['prewarm'])
+    self.assertEqual(False, Config.load('test/new-relic-with-blank-values.ini')['prewarm'])
+
   def test_load_units_removal_config(self):
     self.assertEqual(3, self.config['retry_times'])
     self.assertEqual(0, self.config['retry_sleep'])
+    self.assertEqual(60, self.config['retry_max_sleep'])
+    self.assertEqual(0, self.config['retry_deadline'])
+    self.assertEqual(True, self.config['drain_in_background'])
+
+  def test_load_scaling_config(self):
+    self.assertEqual(4, self.config['max_workers'])
+
+  def test_load_scaling_default_config(self):
+    self.config = Config.load('test/new-relic-with-blank-values.ini')
+    self.assertEqual(1, self.config['max_workers'])
+
+  def test_load_notifications_config(self):
+    self.assertEqual(5, self.config['notifications']['timeout'])
+    self.assertEqual(10, self.config['notifications']['join_timeout'])
+
+  def test_load_readiness_config(self):
+    self.assertEqual(300, self.config['readiness_timeout'])
+
+  def test_load_deploy_strategy(self):
+    self.assertEqual('promote', self.config['deploy_strategy'])
+    self.assertEqual('build', Config.load('test/new-relic-with-blank-values.ini')['deploy_strategy'])
+
+  def test_load_rate_limit_config(self):
+    self.assertEqual({'rate': 5.0, 'burst': 0, 'concurrency': 4, 'max_retries': 3, 'max_wait': 60}, self.config['rate_limit'])
+
+  def test_load_rolling_swap_config(self):
+    self.assertEqual({'enabled': True, 'max_surplus': 1, 'threshold': 0.5}, self.config['rolling_swap'])
+
+  def test_load_rolling_swap_defaults(self):
+    config = Config.load('test/new-relic-with-blank-values.ini')
+    self.assertEqual({'enabled': False, 'max_surplus': 1, 'threshold': 1.0}, config['rolling_swap'])
+
+  def test_load_fleet_from_application_sections(self):
+    configs = Config.load_fleet('test/fleet.ini')
+
+    self.assertEqual(['app-one', 'app-two-custom'], [config['name'] for config in configs])
+    self.assertEqual('./build', configs[0]['deploy_dir'])
+    self.assertEqual(None, configs[1]['deploy_dir'])
+    self.assertEqual(5, configs[1]['retry_times'])
+
+  def test_load_fleet_from_directory(self):
+    configs = Config.load_fleet('test/fleet')
+
+    self.assertEqual(['app-one', 'app-two'], [config['name'] for config in configs])
+    self.assertEqual('./build', configs[1]['deploy_dir'])
+
+  def test_load_metrics_config(self):
+    self.assertEqual(None, self.config['metrics']['json_report'])
+    self.assertEqual('/var/lib/node_exporter/bluegreen.prom', self.config['metrics']['prometheus_textfile'])
+
+  def test_load_deploy_log_config(self):
+    self.assertEqual('logs', self.config['deploy_log']['directory'])
+    self.assertEqual(100, self.config['deploy_log']['tail_lines'])
+
+  def test_load_deploy_log_keeps_at_least_one_tail_line(self):
+    directory = tempfile.mkdtemp()
+    try:
+      ini = os.path.join(directory, 'tsuru-bluegreen.ini')
+      with open('test/tsuru-bluegreen.ini') as source:
+        content = source.read()
+      with open(ini, 'w') as target:
+        target.write(content.replace('directory: logs', 'directory: logs\ntail_lines: 0'))
+
+      self.assertEqual(1, Config.load(ini)['deploy_log']['tail_lines'])
+    finally:
+      shutil.rmtree(directory)
+
+class TestConfigCache(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    os.environ['TSURU_BLUEGREEN_CACHE_DIR'] = os.path.join(self.directory, 'cache')
+    self.ini = os.path.join(self.directory, 'tsuru-bluegreen.ini')
+    shutil.copy('test/tsuru-bluegreen.ini', self.ini)
+
+  def tearDown(self):
+    del os.environ['TSURU_BLUEGREEN_CACHE_DIR']
+    shutil.rmtree(self.directory)
+
+  def test_load_cached_matches_load(self):
+    self.assertEqual(Config.load(self.ini), Config.load_cached(self.ini))
+    self.assertEqual(Config.load(self.ini), Config.load_cached(self.ini))
+
+  def test_load_cached_returns_str_values(self):
+    Config.load_cached(self.ini)
+    config = Config.load_cached(self.ini)
+
+    self.assertEqual(str, type(config['name']))
+    self.assertEqual(str, type(config['hooks']['before_pre']))
+
+  def test_load_cached_does_not_parse_unchanged_file(self):
+    Config.load_cached(self.ini)
+    with patch.object(Config, 'load', side_effect=AssertionError('parsed again')):
+      self.assertEqual('app-test', Config.load_cached(self.ini)['name'])
+
+  def test_load_cached_reloads_changed_file(self):
+    Config.load_cached(self.ini)
+    with open(self.ini) as ini:
+      content = ini.read()
+    with open(self.ini, 'w') as ini:
+      ini.write(content.replace('name: app-test', 'name: app-changed'))
+
+    self.assertEqual('app-changed', Config.load_cached(self.ini)['name'])
+
+  def test_load_cached_reloads_when_newrelic_environment_changes(self):
+    ini = 'test/new-relic-with-blank-values.ini'
+    os.environ['NEW_RELIC_API_KEY'] = 'first-key'
+    try:
+      Config.load_cached(ini)
+      os.environ['NEW_RELIC_API_KEY'] = 'second-key'
+      self.assertEqual('second-key', Config.load_cached(ini)['newrelic']['api_key'])
+    finally:
+      del os.environ['NEW_RELIC_API_KEY']
+
+  def test_load_cached_keeps_newrelic_environment_out_of_the_cache(self):
+    ini = 'test/new-relic-with-blank-values.ini'
+    os.environ['NEW_RELIC_API_KEY'] = 'secret-key'
+    try:
+      Config.load_cached(ini)
+      with patch.object(Config, 'load', side_effect=AssertionError('parsed again')):
+        self.assertEqual('secret-key', Config.load_cached(ini)['newrelic']['api_key'])
+    finally:
+      del os.environ['NEW_RELIC_API_KEY']
+
+    path = Config.cache_path(ini, 'Application')
+    with open(path) as cache:
+      self.assertNotIn('secret-key', cache.read())
+    self.assertEqual(0600, os.stat(path).st_mode & 0777)
+
+  def test_load_cached_ignores_unwritable_cache(self):
+    os.environ['TSURU_BLUEGREEN_CACHE_DIR'] = os.path.join(self.ini, 'not-a-directory')
+
+    self.assertEqual('app-test', Config.load_cached(self.ini)['name'])
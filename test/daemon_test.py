@@ -0,0 +1,100 @@
+import httplib
+import json
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from bluegreen import Daemon
+from fake_tsuru import FakeTsuru
+
+class TestDaemon(unittest.TestCase):
+
+  def setUp(self):
+    self.tsuru = FakeTsuru().start()
+    self.tsuru.add_app('test-app-blue', {'web': 2}, cname=['test.example.com'], env={'TAG': 'v1'})
+    self.tsuru.add_app('test-app-green', {}, env={'TAG': 'v2'})
+    self.tsuru.add_app('other-app-blue', {'web': 1}, cname=['other.example.com'], env={'TAG': 'v1'})
+    self.tsuru.add_app('other-app-green', {}, env={'TAG': 'v2'})
+
+    self.state_dir = tempfile.mkdtemp()
+    self.state_dir_patch = patch('bluegreen.STATE_DIR', self.state_dir)
+    self.state_dir_patch.start()
+
+    configs = [dict(name=name, deploy_dir='.', retry_times=3, retry_sleep=0, hooks={}, newrelic={}, grafana={}, webhook={})
+               for name in ['test-app', 'other-app']]
+    self.daemon = Daemon('token', self.tsuru.target, configs).start('127.0.0.1:0')
+
+  def tearDown(self):
+    self.daemon.stop()
+    self.tsuru.stop()
+    self.state_dir_patch.stop()
+    shutil.rmtree(self.state_dir)
+
+  def call(self, method, path, body=None):
+    conn = httplib.HTTPConnection(self.daemon.address)
+    try:
+      conn.request(method, path, body)
+      response = conn.getresponse()
+      return response.status, json.loads(response.read())
+    finally:
+      conn.close()
+
+  def test_swap_waits_for_the_job_and_status_shows_the_new_live_app(self):
+    status, job = self.call('POST', '/apps/test-app/swap?wait=1')
+    self.assertEqual(status, 200)
+    self.assertEqual((job['state'], job['status']), ('done', 0))
+
+    status, app = self.call('GET', '/apps/test-app')
+    self.assertEqual(status, 200)
+    self.assertEqual((app['live'], app['pre'], app['cname']), ('test-app-green', 'test-app-blue', ['test.example.com']))
+    self.assertEqual([job['action'] for job in app['jobs']], ['swap'])
+
+  def test_jobs_read_the_apps_afresh(self):
+    self.assertEqual(self.call('GET', '/apps/test-app')[0], 200)
+    # A build starts a unit on pre after the status request read it
+    self.tsuru.change_units('test-app-green', 'web', 1)
+
+    self.assertEqual(self.call('POST', '/apps/test-app/swap?wait=1')[1]['status'], 0)
+    self.assertEqual(len(self.tsuru.apps['test-app-green']['units']), 2)
+
+  def test_jobs_that_raise_still_export_metrics(self):
+    bluegreen = self.daemon.app('test-app')['bluegreen']
+    with patch.object(bluegreen, 'deploy_swap', side_effect=Exception('boom')), \
+         patch.object(bluegreen, 'export_metrics') as export_metrics:
+      job = self.call('POST', '/apps/test-app/swap?wait=1')[1]
+
+    self.assertEqual((job['state'], job['error']), ('failed', 'boom'))
+    self.assertEqual(export_metrics.call_count, 1)
+
+  def test_status_leaves_the_job_instance_alone(self):
+    bluegreen = self.daemon.app('test-app')['bluegreen']
+    with patch.object(bluegreen, 'discover', side_effect=AssertionError('read by the job instance')):
+      status, app = self.call('GET', '/apps/test-app')
+
+    self.assertEqual((status, app['live']), (200, 'test-app-blue'))
+    self.assertEqual(bluegreen.metrics.requests, [])
+
+  def test_jobs_of_an_app_run_one_at_a_time_in_order(self):
+    first = self.call('POST', '/apps/test-app/swap')[1]
+    status, second = self.call('POST', '/apps/test-app/swap')
+    self.assertEqual(status, 202)
+
+    second = self.daemon.wait(second['id'])
+    first = self.daemon.job(first['id'])
+    self.assertEqual((first['status'], second['status']), (0, 0))
+    self.assertGreaterEqual(second['started_at'], first['started_at'] + first['elapsed'])
+    self.assertEqual(self.tsuru.apps['test-app-blue']['cname'], ['test.example.com'])
+    self.assertEqual(len(self.tsuru.swaps), 2)
+
+  def test_apps_keep_their_connections_between_jobs(self):
+    for _ in range(3):
+      self.assertEqual(self.call('POST', '/apps/other-app/swap?wait=1')[1]['status'], 0)
+
+    self.assertLessEqual(self.daemon.apps['other-app']['bluegreen'].pool.stats['new'], 2)
+
+  def test_rejects_unknown_apps_and_bad_requests(self):
+    self.assertEqual(self.call('POST', '/apps/unknown/swap')[0], 404)
+    self.assertEqual(self.call('GET', '/apps/test-app/pre')[0], 405)
+    self.assertEqual(self.call('POST', '/apps/test-app/pre', 'not json')[0], 400)
+    self.assertEqual(self.call('GET', '/jobs/42')[0], 404)
+    self.assertEqual(self.call('GET', '/apps'), (200, {'apps': ['other-app', 'test-app']}))
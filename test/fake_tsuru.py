@@ -0,0 +1,183 @@
+"""In-process fake of the parts of the tsuru API used by bluegreen.
+
+It keeps apps in memory, records an event for each unit change, can delay
+every response, answer unit removals with lock conflicts and report running
+events, so whole pre and swap flows can be measured without a tsuru cluster.
+"""
+import calendar
+import json
+import re
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, parse_qs
+
+
+class FakeTsuruHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  wbufsize = -1
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    self.handle_request('GET')
+
+  def do_POST(self):
+    self.handle_request('POST')
+
+  def do_PUT(self):
+    self.handle_request('PUT')
+
+  def do_DELETE(self):
+    self.handle_request('DELETE')
+
+  def handle_request(self, method):
+    length = int(self.headers.getheader('content-length') or 0)
+    body = self.rfile.read(length) if length else ''
+    url = urlparse(self.path)
+    status, payload = self.server.tsuru.dispatch(method, url.path, parse_qs(url.query), parse_qs(body))
+
+    data = '' if payload is None else json.dumps(payload)
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class FakeTsuru:
+  def __init__(self, latency=0, lock_conflicts=0, running_events=0):
+    self.latency = latency
+    self.lock_conflicts = lock_conflicts
+    self.running_events = running_events
+    self.swap_failures = 0
+    self.apps = {}
+    self.requests = []
+    self.swaps = []
+    self.events = []
+    self.peak_units = 0
+    self.lock = threading.Lock()
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTsuruHandler)
+    self.server.tsuru = self
+    self.thread = None
+
+  @property
+  def target(self):
+    return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+  def start(self):
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def add_app(self, name, units=None, cname=None, env=None):
+    self.apps[name] = {'cname': list(cname or []), 'units': [], 'env': dict(env or {})}
+    for process_name, count in (units or {}).items():
+      self.change_units(name, process_name, count)
+
+  def change_units(self, app, process_name, count):
+    units = self.apps[app]['units']
+    if count > 0:
+      for _ in range(count):
+        units.append({'ID': '%s-%s-%d' % (app, process_name, len(units)), 'ProcessName': process_name, 'Status': 'started'})
+    else:
+      for _ in range(-count):
+        for unit in units:
+          if unit['ProcessName'] == process_name:
+            units.remove(unit)
+            break
+    self.peak_units = max(self.peak_units, sum(len(app['units']) for app in self.apps.values()))
+
+  def add_event(self, app, kind, process_name, units):
+    now = time.time()
+    started = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)) + ('%.6fZ' % (now % 1))[1:]
+    self.events.append({'UniqueID': 'event-%d' % len(self.events), 'StartTime': started, 'EndTime': started,
+                        'Running': False, 'Error': '', 'Kind': {'Type': 'permission', 'Name': kind},
+                        'Target': {'Type': 'app', 'Value': app},
+                        'CustomData': [{'name': 'units', 'value': str(units)}, {'name': 'process', 'value': process_name}]})
+
+  def list_events(self, query):
+    """Events of query's target.value, started since its since, or only the running ones."""
+    app = query.get('target.value', [None])[0]
+    since = None
+    if 'since' in query:
+      since = query['since'][0]
+      since = calendar.timegm(time.strptime(since, '%Y-%m-%dT%H:%M:%SZ'))
+    events = [event for event in self.events if event['Target']['Value'] == app and
+              (since is None or calendar.timegm(time.strptime(event['StartTime'][:19], '%Y-%m-%dT%H:%M:%S')) >= since)]
+    if self.running_events > 0:
+      # A running event the app is locked by, which finishes once reported running_events times
+      self.running_events -= 1
+      events.append({'UniqueID': 'lock-%s' % app, 'StartTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                     'Running': True, 'Kind': {'Type': 'permission', 'Name': 'app.update'},
+                     'Target': {'Type': 'app', 'Value': app}})
+    if query.get('running') == ['true']:
+      events = [event for event in events if event['Running']]
+    return events
+
+  def dispatch(self, method, path, query, form):
+    started = time.time()
+    if self.latency:
+      time.sleep(self.latency)
+    with self.lock:
+      status, payload = self.route(method, path, query, form)
+      self.requests.append({'method': method, 'path': path, 'status': status, 'started': started, 'elapsed': time.time() - started})
+    return status, payload
+
+  def route(self, method, path, query, form):
+    match = re.match(r'^/apps/([^/]+)(/units|/env|/cname)?$', path)
+    if path == '/swap' and method == 'POST':
+      if self.swap_failures > 0:
+        self.swap_failures -= 1
+        return 500, {'Message': 'swap failed'}
+      app1, app2 = form['app1'][0], form['app2'][0]
+      self.swaps.append(dict((name, len(self.apps[name]['units'])) for name in (app1, app2)))
+      self.apps[app1]['cname'], self.apps[app2]['cname'] = self.apps[app2]['cname'], self.apps[app1]['cname']
+      return 200, None
+    if path == '/events' and method == 'GET':
+      events = self.list_events(query)
+      return (200, events) if events else (204, None)
+    if not match or match.group(1) not in self.apps:
+      return 404, None
+
+    app = self.apps[match.group(1)]
+    resource = match.group(2)
+    if resource is None and method == 'GET':
+      return 200, {'name': match.group(1), 'cname': app['cname'], 'units': app['units']}
+    if resource == '/units' and method in ('PUT', 'DELETE'):
+      if method == 'DELETE' and self.lock_conflicts > 0:
+        self.lock_conflicts -= 1
+        return 409, {'Message': 'event locked'}
+      count = int(query['units'][0])
+      self.change_units(match.group(1), query['process'][0], count if method == 'PUT' else -count)
+      self.add_event(match.group(1), 'app.update.unit.add' if method == 'PUT' else 'app.update.unit.remove',
+                     query['process'][0], count)
+      return 200, None
+    if resource == '/env' and method == 'GET':
+      names = query.get('env') or sorted(app['env'])
+      return 200, [{'name': name, 'value': app['env'][name], 'public': True} for name in names if name in app['env']]
+    if resource == '/env' and method == 'POST':
+      index = 0
+      while 'Envs.%d.Name' % index in form:
+        app['env'][form['Envs.%d.Name' % index][0]] = form.get('Envs.%d.Value' % index, [''])[0]
+        index += 1
+      return 200, None
+    if resource == '/cname' and method == 'POST':
+      app['cname'].extend(form.get('cname', []))
+      return 200, None
+    if resource == '/cname' and method == 'DELETE':
+      app['cname'] = [cname for cname in app['cname'] if cname not in query.get('cname', [])]
+      return 200, None
+    return 405, None
@@ -0,0 +1,155 @@
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from bluegreen import BlueGreen
+from fake_tsuru import FakeTsuru
+
+class TestFlowsAgainstFakeTsuru(unittest.TestCase):
+
+  def setUp(self):
+    self.tsuru = FakeTsuru().start()
+    self.tsuru.add_app('test-app-blue', {'web': 4, 'worker': 2}, cname=['test.example.com'], env={'TAG': 'v1'})
+    self.tsuru.add_app('test-app-green', {}, env={'TAG': 'v2'})
+
+    self.config = {
+      'name': 'test-app',
+      'deploy_dir': '.',
+      'retry_times': 3,
+      'retry_sleep': 0,
+      'hooks': {},
+      'newrelic': {},
+      'grafana': {},
+      'webhook': {}
+    }
+    self.state_dir = tempfile.mkdtemp()
+    self.state_dir_patch = patch('bluegreen.STATE_DIR', self.state_dir)
+    self.state_dir_patch.start()
+    self.bg = BlueGreen('token', self.tsuru.target, self.config)
+
+  def tearDown(self):
+    self.bg.pool.close()
+    self.tsuru.stop()
+    self.state_dir_patch.stop()
+    shutil.rmtree(self.state_dir)
+
+  def test_swap_moves_units_and_cnames(self):
+    apps, cname = self.bg.discover()
+    self.assertEqual(apps, ['test-app-blue', 'test-app-green'])
+
+    self.assertEqual(self.bg.deploy_swap(apps, cname), 0)
+
+    self.assertEqual(self.tsuru.apps['test-app-green']['cname'], ['test.example.com'])
+    self.assertEqual(len(self.tsuru.apps['test-app-green']['units']), 6)
+    self.assertEqual(self.tsuru.apps['test-app-blue']['units'], [])
+
+  def test_swap_request_count(self):
+    apps, cname = self.bg.discover()
+    self.bg.deploy_swap(apps, cname)
+
+    # 2 app snapshots, 1 env, 2 unit adds + 2 event checks, 1 swap, 1 snapshot + 2 unit removals
+    self.assertEqual(len(self.tsuru.requests), 11)
+
+  def test_swap_checks_added_units_from_events_instead_of_fetching_the_app(self):
+    apps, cname = self.bg.discover()
+    self.bg.deploy_swap(apps, cname)
+
+    app_fetches = [request for request in self.tsuru.requests if request['path'] == '/apps/test-app-green']
+    self.assertEqual(len(app_fetches), 1)
+
+  def test_swap_plan_estimates_its_request_count(self):
+    apps, cname = self.bg.discover()
+    plan = self.bg.plan_swap(apps, cname)
+    planned = len(self.tsuru.requests)
+
+    self.bg.deploy_swap(apps, cname)
+    self.assertEqual(len(self.tsuru.requests) - planned, plan.calls)
+
+  def test_swap_reuses_connections(self):
+    apps, cname = self.bg.discover()
+    self.bg.deploy_swap(apps, cname)
+
+    self.assertLessEqual(self.bg.pool.stats['new'], 2)
+
+  def test_swap_resumes_after_the_swap_with_the_journaled_colors(self):
+    apps, cname = self.bg.discover()
+    with patch.object(self.bg, 'remove_units', side_effect=IOError('connection reset')):
+      self.assertRaises(IOError, self.bg.deploy_swap, apps, cname)
+    self.assertEqual(self.tsuru.apps['test-app-green']['cname'], ['test.example.com'])
+    self.assertEqual(len(self.tsuru.apps['test-app-blue']['units']), 6)
+
+    self.bg = BlueGreen('token', self.tsuru.target, self.config)
+    requests = len(self.tsuru.requests)
+    apps, cname = self.bg.discover()
+    self.assertEqual(apps, ['test-app-green', 'test-app-blue'])
+    self.assertEqual(self.bg.deploy_swap(apps, cname), 0)
+
+    self.assertEqual(len(self.tsuru.swaps), 1)
+    self.assertEqual(self.tsuru.apps['test-app-green']['cname'], ['test.example.com'])
+    self.assertEqual(len(self.tsuru.apps['test-app-green']['units']), 6)
+    self.assertEqual(self.tsuru.apps['test-app-blue']['units'], [])
+    # 2 app snapshots to discover, then only the 2 unit removals
+    self.assertEqual(len(self.tsuru.requests) - requests, 2 + 2)
+
+  def test_swap_starts_over_after_a_failed_swap_scaled_pre_back_down(self):
+    self.tsuru.change_units('test-app-green', 'web', 1)
+    self.tsuru.swap_failures = 1
+    apps, cname = self.bg.discover()
+    self.assertEqual(self.bg.deploy_swap(apps, cname), 2)
+    self.assertEqual(len(self.tsuru.apps['test-app-green']['units']), 2)
+
+    self.bg = BlueGreen('token', self.tsuru.target, self.config)
+    apps, cname = self.bg.discover()
+    self.assertEqual(self.bg.deploy_swap(apps, cname), 0)
+
+    self.assertEqual(self.tsuru.apps['test-app-green']['cname'], ['test.example.com'])
+    self.assertEqual(len(self.tsuru.apps['test-app-green']['units']), 6)
+    self.assertEqual(self.tsuru.apps['test-app-blue']['units'], [])
+
+  def test_rolling_swap_restores_live_units_after_a_failed_swap(self):
+    self.tsuru.add_app('test-app-blue', {'web': 6, 'worker': 2}, cname=['test.example.com'], env={'TAG': 'v1'})
+    self.tsuru.swap_failures = 1
+    self.config['rolling_swap'] = {'enabled': True, 'max_surplus': 2, 'threshold': 1.0}
+    self.bg = BlueGreen('token', self.tsuru.target, self.config)
+
+    apps, cname = self.bg.discover()
+    self.assertEqual(self.bg.deploy_swap(apps, cname), 2)
+
+    self.assertEqual(self.tsuru.apps['test-app-blue']['cname'], ['test.example.com'])
+    self.bg.clear_cache()
+    self.assertEqual(self.bg.total_units('test-app-blue'), {'web': 6, 'worker': 2})
+    self.assertEqual(self.bg.total_units('test-app-green'), {'web': 1, 'worker': 1})
+
+  def test_remove_units_retries_lock_conflicts(self):
+    self.tsuru.lock_conflicts = 2
+    self.tsuru.running_events = 1
+
+    self.assertTrue(self.bg.remove_units('test-app-blue'))
+    self.assertEqual(self.tsuru.apps['test-app-blue']['units'], [])
+
+  def test_rolling_swap_bounds_peak_units(self):
+    self.tsuru.add_app('test-app-blue', {'web': 8, 'worker': 2}, cname=['test.example.com'], env={'TAG': 'v1'})
+    self.tsuru.peak_units = 10
+    self.config['rolling_swap'] = {'enabled': True, 'max_surplus': 2, 'threshold': 0.5}
+    self.bg = BlueGreen('token', self.tsuru.target, self.config)
+
+    apps, cname = self.bg.discover()
+    self.assertEqual(self.bg.deploy_swap(apps, cname), 0)
+
+    self.assertEqual(self.tsuru.apps['test-app-green']['cname'], ['test.example.com'])
+    self.assertEqual(len(self.tsuru.apps['test-app-green']['units']), 10)
+    self.assertEqual(self.tsuru.apps['test-app-blue']['units'], [])
+    self.assertLessEqual(self.tsuru.peak_units, 10 + 2 * 2)
+    self.assertGreaterEqual(self.tsuru.swaps[0]['test-app-green'], 5)
+    self.assertGreaterEqual(self.tsuru.swaps[0]['test-app-blue'], 2)
+
+  def test_rolling_swap_keeps_old_units_while_pre_is_below_threshold(self):
+    self.tsuru.change_units('test-app-green', 'web', 1)
+    self.config['rolling_swap'] = {'enabled': True, 'max_surplus': 1, 'threshold': 1.0}
+    self.bg = BlueGreen('token', self.tsuru.target, self.config)
+
+    apps, cname = self.bg.discover()
+    self.assertEqual(self.bg.deploy_swap(apps, cname), 0)
+
+    self.assertEqual(self.tsuru.swaps[0], {'test-app-blue': 2, 'test-app-green': 6})
+    self.assertLessEqual(self.tsuru.peak_units, 6 + 2)
@@ -0,0 +1,96 @@
+"""Startup benchmark of the bluegreen command line, one action at a time.
+
+  python test/startup_benchmark.py --runs 5
+
+Runs `python src/bluegreen.py <action>` against a fake tsuru API, with a cold
+and with a warm config cache, and prints how long each action takes to reach
+its first API request (pre, swap) or to finish (cname, drain-status).
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import fake_tsuru_client, percentile
+from fake_tsuru import FakeTsuru
+
+BLUEGREEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bluegreen.py')
+
+INI = """[Application]
+name: bench
+deploy_dir: .
+
+[UnitsRemoval]
+retry_times: 3
+retry_sleep: 0
+
+[NewRelic]
+api_key: some-api-key
+app_id: 123
+"""
+
+
+def run_action(action, workdir, env):
+  """Time one run of an action, returning (time to first request, total time)."""
+  tsuru = FakeTsuru().start()
+  try:
+    tsuru.add_app('bench-blue', {'web': 2}, cname=['bench.example.com'], env={'TAG': 'v1'})
+    tsuru.add_app('bench-green', {}, env={'TAG': 'v2'})
+    env = dict(env, TSURU_TARGET=tsuru.target, TSURU_TOKEN='token')
+
+    with open(os.devnull, 'w') as devnull:
+      started = time.time()
+      subprocess.call([sys.executable, BLUEGREEN, action, '-t', 'v2'], cwd=workdir, env=env,
+                      stdout=devnull, stderr=devnull)
+      elapsed = time.time() - started
+
+    first_request = tsuru.requests[0]['started'] - started if tsuru.requests else elapsed
+    return first_request, elapsed
+  finally:
+    tsuru.stop()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark bluegreen command line startup for each action.')
+  parser.add_argument('--runs', type=int, default=5, help='runs of each action and cache state (default: 5)')
+  parser.add_argument('--actions', default='cname,drain-status,pre,swap', help='comma separated actions (default: cname,drain-status,pre,swap)')
+  options = parser.parse_args()
+
+  workdir = tempfile.mkdtemp()
+  cache_dir = tempfile.mkdtemp()
+  fake_client = fake_tsuru_client()
+  with open(os.path.join(workdir, 'tsuru-bluegreen.ini'), 'w') as ini:
+    ini.write(INI)
+  env = dict(os.environ, PATH=fake_client + os.pathsep + os.environ['PATH'], TSURU_BLUEGREEN_CACHE_DIR=cache_dir)
+
+  results = []
+  try:
+    for action in options.actions.split(','):
+      for cache in ('cold', 'warm'):
+        first_requests, totals = [], []
+        for run in range(options.runs):
+          if cache == 'cold':
+            shutil.rmtree(cache_dir, ignore_errors=True)
+          else:
+            run_action('drain-status', workdir, env)
+          first_request, elapsed = run_action(action, workdir, env)
+          first_requests.append(first_request)
+          totals.append(elapsed)
+        results.append((action, cache, percentile(first_requests, 0.5), percentile(totals, 0.5)))
+  finally:
+    shutil.rmtree(workdir)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    shutil.rmtree(fake_client)
+
+  print '%-13s %6s %20s %11s' % ('action', 'cache', 'first request(ms)', 'total(ms)')
+  for action, cache, first_request, total in results:
+    print '%-13s %6s %20.1f %11.1f' % (action, cache, first_request * 1000, total * 1000)
+
+
+if __name__ == '__main__':
+  main()